@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#coding=utf-8
+'''
+Micro-benchmark of request signing.
+
+Compares the old get_assign (logger lookup, eager debug formatting,
+safe_get_element scans and a new HMAC per call) with OssSigner.sign
+(one pass over the headers and a copy of the precomputed HMAC state).
+
+usage: python benchmarks/bench_sign.py [loop_num]
+'''
+import base64
+import hmac
+import os
+import sys
+import timeit
+from hashlib import sha1 as sha
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from oss.oss_util import *
+
+def legacy_format_header(headers=None):
+    if not headers:
+        headers = {}
+    tmp_headers = {}
+    for k in headers.keys():
+        if k.lower().startswith(SELF_DEFINE_HEADER_PREFIX):
+            k_lower = k.lower()
+            tmp_headers[k_lower] = headers[k]
+        else:
+            tmp_headers[k] = headers[k]
+    return tmp_headers
+
+def legacy_get_resource(params=None):
+    if not params:
+        return ""
+    tmp_headers = {}
+    for k, v in params.items():
+        tmp_k = k.lower().strip()
+        tmp_headers[tmp_k] = v
+    override_response_list = ['response-content-type', 'response-content-language', \
+                              'response-cache-control', 'logging', 'response-content-encoding', \
+                              'acl', 'uploadId', 'uploads', 'partNumber', 'group', \
+                              'delete', 'website', 'location', 'objectInfo', \
+                              'response-expires', 'response-content-disposition']
+    override_response_list.sort()
+    resource = ""
+    separator = "?"
+    for i in override_response_list:
+        if i.lower() in tmp_headers:
+            resource += separator
+            resource += i
+            tmp_key = str(tmp_headers[i.lower()])
+            if len(tmp_key) != 0:
+                resource += "="
+                resource += tmp_key
+            separator = '&'
+    return resource
+
+def legacy_get_assign(secret_access_key, method, headers=None, resource="/", result=None, debug=DEBUG):
+    if not headers:
+        headers = {}
+    if not result:
+        result = []
+    canonicalized_oss_headers = ""
+    logger = getlogger(debug)
+    logger.debug("secret_access_key: %s" % secret_access_key)
+    content_md5 = safe_get_element('Content-MD5', headers)
+    content_type = safe_get_element('Content-Type', headers)
+    date = safe_get_element('Date', headers)
+    canonicalized_resource = resource
+    tmp_headers = legacy_format_header(headers)
+    if len(tmp_headers) > 0:
+        x_header_list = sorted(tmp_headers.keys())
+        for k in x_header_list:
+            if k.startswith(SELF_DEFINE_HEADER_PREFIX):
+                canonicalized_oss_headers += "%s:%s\n" % (k, tmp_headers[k])
+    string_to_sign = method + "\n" + content_md5.strip() + "\n" + content_type + "\n" + date + "\n" + canonicalized_oss_headers + canonicalized_resource
+    result.append(string_to_sign)
+    logger.debug("method:%s\n content_md5:%s\n content_type:%s\n data:%s\n canonicalized_oss_headers:%s\n canonicalized_resource:%s\n" % (method, content_md5, content_type, date, canonicalized_oss_headers, canonicalized_resource))
+    logger.debug("string_to_sign:%s\n \nlength of string_to_sign:%d\n" % (string_to_sign, len(string_to_sign)))
+    h = hmac.new(secret_access_key.encode(), string_to_sign.encode(), sha)
+    sign_result = base64.b64encode(h.digest()).decode().strip()
+    logger.debug("sign result:%s" % sign_result)
+    return sign_result
+
+def main():
+    loop_num = 100000
+    if len(sys.argv) > 1:
+        loop_num = int(sys.argv[1])
+    secret_access_key = "OtxrzxIsfpFjA7SwPzILwy8Bw21TLhquhboDYROV"
+    headers = {'Host': 'bucket.oss.aliyuncs.com', 'Date': 'Thu, 17 Nov 2005 18:49:58 GMT',
+               'Content-Type': 'text/html', 'Content-MD5': 'ODBGOERFMDMzQTczRUY3NUE3NzA5QzdFNUYzMDQxNEM=',
+               'User-Agent': 'oss-python0.3.2 (linux)', 'X-OSS-Meta-Author': 'foo@bar.com',
+               'x-oss-meta-magic': 'abracadabra', 'x-oss-meta-a': '1', 'x-oss-meta-b': '2'}
+    params = {'uploadId': '0004B9894A22E5B1888A1E29F8236E2D', 'partNumber': 3}
+    resource = "/bucket/object"
+    signer = OssSigner(secret_access_key)
+
+    assert legacy_get_resource(params) == get_resource(params)
+    assert legacy_get_assign(secret_access_key, "PUT", headers, resource + legacy_get_resource(params)) == \
+           signer.sign("PUT", headers, resource + get_resource(params))
+
+    bench_list = [
+        ("legacy get_resource", lambda: legacy_get_resource(params)),
+        ("get_resource", lambda: get_resource(params)),
+        ("legacy get_assign", lambda: legacy_get_assign(secret_access_key, "PUT", headers, resource)),
+        ("get_assign", lambda: get_assign(secret_access_key, "PUT", headers, resource)),
+        ("OssSigner.sign", lambda: signer.sign("PUT", headers, resource)),
+    ]
+    for (name, func) in bench_list:
+        cost = min(timeit.repeat(func, number=loop_num, repeat=3))
+        print("%-22s %8.2f us/call" % (name, cost * 1000000 / loop_num))
+
+if __name__ == '__main__':
+    main()
@@ -29,6 +29,8 @@ import base64
 import urllib
 import io
 import sys
+import threading
+import concurrent.futures
 try:
     from oss.oss_util import *
 except:
@@ -41,6 +43,7 @@ except:
 class OssAPI:
     '''
     A simple OSS API
+    One instance can be shared by many threads.
     '''
     DefaultContentType = 'application/octet-stream'
     provider = PROVIDER
@@ -49,7 +52,8 @@ class OssAPI:
     AGENT = 'oss-python%s (%s)' % (__version__, sys.platform)
 
     def __init__(self, host, access_id, secret_access_key='', port=80, is_security=False):
-        self.SendBufferSize = 8192
+        self.SendBufferSize = 1024*1024
+        self.SendFileSliceSize = 64*1024*1024
         self.RecvBufferSize = 1024*1024*10
         self.host = get_second_level_domain(host)
         self.port = port
@@ -58,15 +62,44 @@ class OssAPI:
         self.show_bar = False
         self.is_security = is_security
         self.retry_times = 5
+        self.retry_policy = RetryPolicy(self.retry_times)
         self.agent = self.AGENT
         self.debug = False
+        self.signer = OssSigner(self.secret_access_key, self.debug)
+        self.conn_pool = ConnectionPool()
+        self.endpoint_cache = EndpointCache()
+        self.use_bucket_location = False
+        self.sign_url_cache = None
+        self.local = threading.local()
+        self.buffer_pool = BufferPool()
+        self.throughput_meter = ThroughputMeter()
+        self.hash_index = None
 
     def set_debug(self, is_debug):
         if is_debug:
             self.debug = True
+            self.signer.debug = True
+
+    def get_signer(self):
+        '''
+        Get the OssSigner of the current secret_access_key.
+        '''
+        signer = self.signer
+        if signer.secret_access_key != self.secret_access_key:
+            signer = OssSigner(self.secret_access_key, self.debug)
+            self.signer = signer
+        return signer
 
     def set_retry_times(self, retry_times=5):
         self.retry_times = retry_times
+        self.retry_policy.max_retries = retry_times
+
+    def set_retry_policy(self, retry_policy):
+        '''
+        Replace the RetryPolicy shared by all operations of this instance.
+        '''
+        self.retry_policy = retry_policy
+        self.retry_times = retry_policy.max_retries
 
     def set_send_buf_size(self, buf_size):
         try:
@@ -80,6 +113,126 @@ class OssAPI:
         except ValueError:
             pass
 
+    def set_connection_pool(self, max_idle=10, max_size=100, idle_timeout=60):
+        '''
+        Replace the keep-alive connection pool, idle connections of the old one are closed.
+
+        :type max_idle: int
+        :param: idle connections kept for one host
+
+        :type max_size: int
+        :param: idle connections kept for all hosts
+
+        :type idle_timeout: int
+        :param: seconds before an idle connection is dropped
+        '''
+        old_pool = self.conn_pool
+        self.conn_pool = ConnectionPool(max_idle, max_size, idle_timeout)
+        old_pool.clear()
+
+    def close(self):
+        '''
+        Close all idle connections kept by this instance.
+        '''
+        self.conn_pool.clear()
+
+    def set_endpoint_cache(self, ttl=3600, max_size=10000, use_bucket_location=False):
+        '''
+        Replace the per-bucket endpoint cache.
+
+        :type ttl: int
+        :param: seconds a learned endpoint is kept
+
+        :type max_size: int
+        :param: max number of buckets kept
+
+        :type use_bucket_location: bool
+        :param: look up the location of a bucket before its first request,
+                instead of waiting for a redirect
+        '''
+        self.endpoint_cache = EndpointCache(ttl, max_size)
+        self.use_bucket_location = use_bucket_location
+
+    def enable_sign_url_cache(self, max_size=10000, min_valid_time=30):
+        '''
+        Reuse the urls of sign_url and sign_url_auth_with_expire_time for the
+        same arguments while they are valid for more than min_valid_time seconds.
+
+        :type max_size: int
+        :param: max number of urls kept
+
+        :type min_valid_time: int
+        :param: seconds a cached url must still be valid to be returned
+        '''
+        self.sign_url_cache = SignUrlCache(max_size, min_valid_time)
+
+    def disable_sign_url_cache(self):
+        self.sign_url_cache = None
+
+    def enable_hash_index(self, db_path, max_entries=100000):
+        '''
+        Keep the md5 of uploaded files in a HashIndex stored at db_path, so
+        unchanged files are not hashed again by the upload and sync methods.
+
+        :type db_path: string
+        :param: path of the sqlite database
+
+        :type max_entries: int
+        :param: max number of md5 entries kept
+        '''
+        self.disable_hash_index()
+        self.hash_index = HashIndex(db_path, max_entries)
+
+    def disable_hash_index(self):
+        if self.hash_index is not None:
+            self.hash_index.close()
+        self.hash_index = None
+
+    def get_host(self, bucket):
+        '''
+        Get the host that requests of bucket are sent to.
+        '''
+        if not bucket:
+            return self.host
+        host = self.endpoint_cache.get(bucket)
+        if host:
+            return host
+        if self.use_bucket_location:
+            host = self.resolve_bucket_endpoint(bucket)
+            if host:
+                return host
+        return self.host
+
+    def resolve_bucket_endpoint(self, bucket):
+        '''
+        Get the endpoint of bucket from its location and put it into the endpoint cache.
+        A location that can not be resolved is cached as the default host, so
+        it is not asked again for every request until the entry expires.
+
+        Returns:
+            the host, or '' if it can not be resolved
+        '''
+        if is_ip(self.host):
+            return ''
+        params = {}
+        params['location'] = ''
+        host = ''
+        try:
+            res = self.http_request_with_redirect('GET', bucket, '', {}, '', params, self.host)
+            if res.status == 301 or res.status == 302:
+                return self._redirect_host(res, bucket, self.host)
+            body = res.read()
+            if res.status == 200:
+                location = GetBucketLocationXml(body).location
+                host = helper_get_host_from_location(location, self.host)
+        except Exception:
+            host = ''
+        if host:
+            self.endpoint_cache.set(bucket, host)
+        else:
+            self.endpoint_cache.set(bucket, self.host)
+        return host
+
     def get_connection(self, tmp_host=None):
         host = ''
         port = 80
@@ -92,17 +245,39 @@ class OssAPI:
         elif len(host_port_list) == 2:
             host = host_port_list[0].strip()
             port = int(host_port_list[1].strip())
-        if self.is_security or port == 443:
-            self.is_security = True
-            if sys.version_info >= (2, 6):
-                return http.client.HTTPSConnection(host=host, port=port, timeout=timeout)
-            else:
-                return http.client.HTTPSConnection(host=host, port=port)
-        else:
-            if sys.version_info >= (2, 6):
-                return http.client.HTTPConnection(host=host, port=port, timeout=timeout)
-            else:
-                return http.client.HTTPConnection(host=host, port=port)
+        is_security = self.is_security or port == 443
+        return self.conn_pool.get(host, port, is_security, timeout)
+
+    def _redirect_host(self, res, bucket, host):
+        '''
+        NOT public API
+        Get the host a 301/302 response points to and remember it for bucket.
+        '''
+        new_host = helper_get_host_from_resp(res, bucket)
+        res.read()
+        if not new_host:
+            return host
+        if bucket:
+            self.endpoint_cache.set(bucket, new_host)
+        return new_host
+
+    def _send_request(self, conn, method, url, body, headers):
+        '''
+        NOT public API
+        Send the request on conn and get the response. A pooled connection
+        the server has closed in the meantime is retried once on a new socket,
+        only if the body is in memory and can be sent again as is.
+        '''
+        try:
+            conn.request(method, url, body, headers)
+            return conn.getresponse()
+        except (ConnectionResetError, BrokenPipeError):
+            if not conn.reused or not (body is None or isinstance(body, (str, bytes, bytearray, memoryview))):
+                raise
+        conn.close()
+        conn.reused = False
+        conn.request(method, url, body, headers)
+        return conn.getresponse()
 
     def sign_url_auth_with_expire_time(self, method, url, headers=None, resource="/", timeout=60, params=None):
         '''
@@ -126,17 +301,28 @@ class OssAPI:
         Returns:
             signature url.
         '''
-        if not headers:
-            headers = {}
-        if not params:
-            params = {}
-        send_time = str(int(time.time()) + timeout)
+        #the caller's dicts are neither changed nor keyed with a signature
+        headers = dict(headers or {})
+        params = dict(params or {})
+        cache = self.sign_url_cache
+        if cache is not None and timeout <= cache.min_valid_time:
+            #an url valid for so short is never returned by the cache
+            cache = None
+        if cache is not None:
+            cache_key = get_sign_url_cache_key(self.host, self.access_id, method, url, resource, timeout, headers, params)
+            sign_url = cache.get(cache_key)
+            if sign_url:
+                return sign_url
+        expire_time = int(time.time()) + timeout
+        send_time = str(expire_time)
         headers['Date'] = send_time
-        auth_value = get_assign(self.secret_access_key, method, headers, resource, None, self.debug)
+        auth_value = self.get_signer().sign(method, headers, resource)
         params["OSSAccessKeyId"] = self.access_id
         params["Expires"] = str(send_time)
         params["Signature"] = auth_value
         sign_url = append_param(url, params)
+        if cache is not None:
+            cache.put(cache_key, sign_url, expire_time)
         return sign_url
 
     def sign_url(self, method, bucket, object, timeout=60, headers=None, params=None):
@@ -167,31 +353,103 @@ class OssAPI:
         Returns:
             signature url.
         '''
-        if not headers:
-            headers = {}
-        if not params:
-            params = {}
-        send_time = str(int(time.time()) + timeout)
+        #the caller's dicts are neither changed nor keyed with a signature
+        headers = dict(headers or {})
+        params = dict(params or {})
+        cache = self.sign_url_cache
+        if cache is not None and timeout <= cache.min_valid_time:
+            #an url valid for so short is never returned by the cache
+            cache = None
+        if cache is not None:
+            cache_key = get_sign_url_cache_key(self.host, self.access_id, method, bucket, object, timeout, headers, params)
+            sign_url = cache.get(cache_key)
+            if sign_url:
+                return sign_url
+        expire_time = int(time.time()) + timeout
+        send_time = str(expire_time)
         headers['Date'] = send_time
         resource = "/%s/%s%s" % (bucket, object, get_resource(params))
-        auth_value = get_assign(self.secret_access_key, method, headers, resource, None, self.debug)
+        auth_value = self.get_signer().sign(method, headers, resource)
         params["OSSAccessKeyId"] = self.access_id
         params["Expires"] = str(send_time)
         params["Signature"] = auth_value
-        url = ''
-        if self.is_security:
-            if is_ip(self.host):
-                url = "https://%s/%s/%s" % (self.host, bucket, object)
-            else:
-                url = "https://%s.%s/%s" % (bucket, self.host, object)
-        else:
-            if is_ip(self.host):
-                url = "http://%s/%s/%s" % (self.host, bucket, object)
-            else:
-                url = "http://%s.%s/%s" % (bucket, self.host, object)
+        url = self._get_url_prefix(bucket) + object
         sign_url = append_param(url, params)
+        if cache is not None:
+            cache.put(cache_key, sign_url, expire_time)
         return sign_url
 
+    def _get_url_prefix(self, bucket):
+        '''
+        NOT public API
+        The url of bucket that object names are appended to.
+        '''
+        host = self.get_host(bucket)
+        scheme = "http"
+        if self.is_security:
+            scheme = "https"
+        if is_ip(host):
+            return "%s://%s/%s/" % (scheme, host, bucket)
+        return "%s://%s.%s/" % (scheme, bucket, host)
+
+    def sign_urls(self, bucket, objects, timeout=60, method='GET', headers=None, params=None, process_num=0):
+        '''
+        Create the signature urls of many objects of one bucket in one pass.
+        All urls share one expire time, the same as calling sign_url for each object.
+
+        :type bucket: string
+        :param:
+
+        :type objects: list
+        :param: object names
+
+        :type timeout: int
+        :param
+
+        :type method: string
+        :param method: one of PUT, GET, DELETE, HEAD
+
+        :type headers: dict
+        :param: HTTP header
+
+        :type params: dict
+        :param: the parameters that put in the url address as query string
+
+        :type process_num: int
+        :param: sign in a pool of process_num processes, 0 or 1 signs in this process
+
+        Returns:
+            list of signature urls in the order of objects.
+        '''
+        tmp_headers = {}
+        if headers:
+            tmp_headers = headers.copy()
+        tmp_params = {}
+        if params:
+            tmp_params = params.copy()
+        send_time = str(int(time.time()) + timeout)
+        tmp_headers['Date'] = send_time
+        signer = self.get_signer()
+        string_to_sign_prefix = signer.get_string_to_sign(method, tmp_headers, "/%s/" % bucket)
+        sub_resource = get_resource(tmp_params)
+        tmp_params["OSSAccessKeyId"] = self.access_id
+        tmp_params["Expires"] = send_time
+        url_suffix = append_param("", tmp_params) + "&Signature="
+        url_prefix = self._get_url_prefix(bucket)
+        if not isinstance(objects, list):
+            objects = list(objects)
+        if process_num <= 1 or len(objects) < 2 * process_num:
+            return create_sign_url_list(self.secret_access_key, string_to_sign_prefix, sub_resource, url_prefix, url_suffix, objects)
+        step = (len(objects) + process_num * 4 - 1) // (process_num * 4)
+        sign_url_list = []
+        with concurrent.futures.ProcessPoolExecutor(process_num) as executor:
+            future_list = []
+            for i in range(0, len(objects), step):
+                future_list.append(executor.submit(create_sign_url_list, self.secret_access_key, string_to_sign_prefix, sub_resource, url_prefix, url_suffix, objects[i:i + step]))
+            for future in future_list:
+                sign_url_list.extend(future.result())
+        return sign_url_list
+
     def _create_sign_for_normal_auth(self, method, headers=None, resource="/"):
         '''
         NOT public API
@@ -210,16 +468,16 @@ class OssAPI:
         Returns:
             signature string
         '''
-        auth_value = "%s %s:%s" % (self.provider, self.access_id, get_assign(self.secret_access_key, method, headers, resource, None, self.debug))
+        auth_value = "%s %s:%s" % (self.provider, self.access_id, self.get_signer().sign(method, headers, resource))
         return auth_value
 
     def bucket_operation(self, method, bucket, headers=None, params=None):
         return self.http_request(method, bucket, '', headers, '', params)
 
-    def object_operation(self, method, bucket, object, headers=None, body='', params=None):
-        return self.http_request(method, bucket, object, headers, body, params)
+    def object_operation(self, method, bucket, object, headers=None, body='', params=None, retry_state=None):
+        return self.http_request(method, bucket, object, headers, body, params, retry_state)
 
-    def http_request(self, method, bucket, object, headers=None, body='', params=None):
+    def http_request(self, method, bucket, object, headers=None, body='', params=None, retry_state=None):
         '''
         Send http request of operation
 
@@ -238,30 +496,46 @@ class OssAPI:
         :type body: string
         :param
 
+        :type retry_state: RetryState
+        :param: the retry state of an enclosing retry loop, e.g. one that also
+                retries reading the body, so that the attempts of both loops
+                count against one budget. A new one is started by default.
+
         Returns:
             HTTP Response
         '''
-        retry = 5
+        redirect = 5
         res = None
-        while retry > 0:
-            retry -= 1
+        host = self.get_host(bucket)
+        retry = retry_state
+        if retry is None:
+            retry = self.retry_policy.start()
+        while redirect > 0:
             tmp_bucket = bucket
             tmp_object = object
-            tmp_headers = {}
-            if headers and isinstance(headers, dict):
-                tmp_headers = headers.copy()
+            tmp_headers = HeaderMap(headers)
             tmp_params = {}
             if params and isinstance(params, dict):
                 tmp_params = params.copy()
 
-            res = self.http_request_with_redirect(method, tmp_bucket, tmp_object, tmp_headers, body, tmp_params)
+            try:
+                res = self.http_request_with_redirect(method, tmp_bucket, tmp_object, tmp_headers, body, tmp_params, host)
+            except Exception as e:
+                if self.retry_policy.is_retryable_request_error(method, e) and retry.should_retry(error=e):
+                    retry.sleep()
+                    continue
+                raise
             if res.status == 301 or res.status == 302:
-                self.host = helper_get_host_from_resp(res, bucket)
+                redirect -= 1
+                host = self._redirect_host(res, bucket, host)
+            elif self.retry_policy.is_retryable_request_status(method, res.status) and retry.should_retry(status=res.status):
+                res.read()
+                retry.sleep()
             else:
                 return res
         return res
 
-    def http_request_with_redirect(self, method, bucket, object, headers=None, body='', params=None):
+    def http_request_with_redirect(self, method, bucket, object, headers=None, body='', params=None, host=None):
         '''
         Send http request of operation
 
@@ -280,38 +554,42 @@ class OssAPI:
         :type body: string
         :param
 
+        :type host: string
+        :param: the host to send to, default is the host of bucket
+
         Returns:
             HTTP Response
         '''
         if not params:
             params = {}
-        if not headers:
-            headers = {}
+        if not isinstance(headers, HeaderMap):
+            headers = HeaderMap(headers)
+        if not host:
+            host = self.get_host(bucket)
         if not bucket:
             resource = "/"
-            headers['Host'] = self.host
+            headers['Host'] = host
         else:
-            headers['Host'] = "%s.%s" % (bucket, self.host)
+            headers['Host'] = "%s.%s" % (bucket, host)
             resource = "/%s/" % bucket
         resource = "%s%s%s" % (resource, object, get_resource(params))
         object = urllib.parse.quote(object)
         url = "/%s" % object
-        if is_ip(self.host):
+        if is_ip(host):
             url = "/%s/%s" % (bucket, object)
             if not bucket:
                 url = "/%s" % object
-            headers['Host'] = self.host
+            headers['Host'] = host
         url = append_param(url, params)
         date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
         headers['Date'] = date
         headers['Authorization'] = self._create_sign_for_normal_auth(method, headers, resource)
         headers['User-Agent'] = self.agent
-        if check_bucket_valid(bucket) and not is_ip(self.host):
+        if check_bucket_valid(bucket) and not is_ip(host):
             conn = self.get_connection(headers['Host'])
         else:
-            conn = self.get_connection()
-        conn.request(method, url, body, headers)
-        return conn.getresponse()
+            conn = self.get_connection(host)
+        return self._send_request(conn, method, url, body, headers)
 
     def get_service(self, headers=None):
         '''
@@ -523,14 +801,7 @@ class OssAPI:
         Returns:
             HTTP Response
         '''
-        if not headers:
-            headers = {}
-        headers['Content-Type'] = content_type
-        headers['Content-Length'] = str(len(input_content))
-        fp = io.StringIO(input_content)
-        res = self.put_object_from_fp(bucket, object, fp, content_type, headers, params)
-        fp.close()
-        return res
+        return self.put_object_from_buffer(bucket, object, input_content, content_type, headers, params)
 
     def put_object_from_bytes(self, bucket, object, input_content,
                               content_type=DefaultContentType, headers=None,
@@ -556,16 +827,69 @@ class OssAPI:
         Returns:
             HTTP Response
         '''
-        if not headers:
-            headers = {}
-        headers['Content-Type'] = content_type
-        headers['Content-Length'] = str(len(input_content))
-        fp = io.BytesIO(input_content)
-        res = self.put_object_from_fp(bucket, object, fp, content_type, headers, params)
-        fp.close()
-        return res
+        return self.put_object_from_buffer(bucket, object, input_content, content_type, headers, params)
+
+    def put_object_from_buffer(self, bucket, object, buffer, content_type=DefaultContentType, headers=None, params=None):
+        '''
+        Put object into bucket, the content of object is buffer. Slices of a
+        memoryview of buffer are sent, its content is never copied.
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type buffer: bytes-like
+        :param: bytes, bytearray, memoryview, mmap, NumPy array or any
+                C-contiguous object of the buffer protocol; str is sent as utf-8
+
+        :type content_type: string
+        :param: the object content type that supported by HTTP
 
-    def _open_conn_to_put_object(self, bucket, object, filesize, content_type=DefaultContentType, headers=None, params=None):
+        :type headers: dict
+        :param: HTTP header
+
+        Returns:
+            HTTP Response
+        '''
+        view = get_byte_view(buffer)
+        length = view.nbytes
+        host = self.get_host(bucket)
+        retry = self.retry_policy.start()
+        while True:
+            tmp_headers = HeaderMap(headers)
+            tmp_params = {}
+            if params and isinstance(params, dict):
+                tmp_params = params.copy()
+            conn = None
+            try:
+                conn = self._open_conn_to_put_object(bucket, object, length, content_type, tmp_headers, tmp_params, host)
+                totallen = 0
+                while totallen < length:
+                    end = min(totallen + self.SendBufferSize, length)
+                    conn.send(view[totallen:end])
+                    totallen = end
+                    if self.show_bar:
+                        self.view_bar(totallen, length)
+                res = conn.getresponse()
+            except Exception as e:
+                if conn is not None:
+                    conn.close()
+                if retry.should_retry(error=e):
+                    retry.sleep()
+                    continue
+                raise
+            if res.status == 301 or res.status == 302:
+                host = self._redirect_host(res, bucket, host)
+                continue
+            if retry.should_retry(status=res.status):
+                res.read()
+                retry.sleep()
+                continue
+            return res
+
+    def _open_conn_to_put_object(self, bucket, object, filesize, content_type=DefaultContentType, headers=None, params=None, host=None):
         '''
         NOT public API
         Open a connectioon to put object
@@ -574,7 +898,7 @@ class OssAPI:
         :param
 
         :type filesize: int
-        :param
+        :param: None sends the body with chunked transfer encoding
 
         :type object: string
         :param
@@ -588,13 +912,18 @@ class OssAPI:
         :type headers: dict
         :param: HTTP header
 
+        :type host: string
+        :param: the host to send to, default is the host of bucket
+
         Returns:
             Initialized HTTPConnection
         '''
         if not params:
             params = {}
-        if not headers:
-            headers = {}
+        if not isinstance(headers, HeaderMap):
+            headers = HeaderMap(headers)
+        if not host:
+            host = self.get_host(bucket)
         method = 'PUT'
         resource = "/%s/" % bucket
         if not bucket:
@@ -604,22 +933,26 @@ class OssAPI:
         object = urllib.parse.quote(object)
         url = "/%s" % object
         if bucket:
-            headers['Host'] = "%s.%s" % (bucket, self.host)
+            headers['Host'] = "%s.%s" % (bucket, host)
         else:
-            headers['Host'] = self.host
-        if is_ip(self.host):
+            headers['Host'] = host
+        if is_ip(host):
             url = "/%s/%s" % (bucket, object)
-            headers['Host'] = self.host
+            headers['Host'] = host
         url = append_param(url, params)
         date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
 
-        if check_bucket_valid(bucket) and not is_ip(self.host):
+        if check_bucket_valid(bucket) and not is_ip(host):
             conn = self.get_connection(headers['Host'])
         else:
-            conn = self.get_connection()
+            conn = self.get_connection(host)
         conn.putrequest(method, url)
         headers["Content-Type"] = content_type
-        headers["Content-Length"] = filesize
+        if filesize is None:
+            headers.pop("Content-Length", None)
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            headers["Content-Length"] = filesize
         headers["Date"] = date
         headers["Expect"] = "100-Continue"
         headers['User-Agent'] = self.agent
@@ -631,7 +964,7 @@ class OssAPI:
         conn.endheaders()
         return conn
 
-    def put_object_from_file(self, bucket, object, filename, content_type='', headers=None, params=None):
+    def put_object_from_file(self, bucket, object, filename, content_type='', headers=None, params=None, compression=None):
         '''
         put object into bucket, the content of object is read from file
 
@@ -650,13 +983,16 @@ class OssAPI:
         :type headers: dict
         :param: HTTP header
 
+        :type compression: string
+        :param: see put_object_from_fp
+
         Returns:
             HTTP Response
         '''
         fp = open(filename, 'rb')
         if not content_type:
             content_type = get_content_type_by_filename(filename)
-        res = self.put_object_from_fp(bucket, object, fp, content_type, headers, params)
+        res = self.put_object_from_fp(bucket, object, fp, content_type, headers, params, compression)
         fp.close()
         return res
 
@@ -666,7 +1002,80 @@ class OssAPI:
         print('\r%d%% ' % (rate_num),end='')
         sys.stdout.flush()
 
-    def put_object_from_fp(self, bucket, object, fp, content_type=DefaultContentType, headers=None, params=None):
+    def _get_send_buffer(self):
+        '''
+        NOT public API
+        The send buffer of the current thread, reused by all its uploads.
+        '''
+        buf = getattr(self.local, 'send_buffer', None)
+        if buf is None or len(buf) != self.SendBufferSize:
+            buf = bytearray(self.SendBufferSize)
+            self.local.send_buffer = buf
+        return buf
+
+    def _can_sendfile(self, conn, fp):
+        '''
+        NOT public API
+        Whether _send_file_range sends fp on conn with os.sendfile.
+        '''
+        return not isinstance(conn, http.client.HTTPSConnection) and get_sendfile_fileno(fp) != -1
+
+    def _send_file_range(self, conn, fp, offset, length, hasher=None):
+        '''
+        NOT public API
+        Send length bytes of fp from offset on an opened put connection.
+        A regular file on a plain HTTP connection is sent by os.sendfile,
+        anything else is read with readinto into the reused send buffer.
+        If hasher is given every sent byte is also fed to it, so sendfile
+        is not used.
+
+        Returns:
+            the number of bytes sent
+        '''
+        totallen = 0
+        fileno = -1
+        if hasher is None and not isinstance(conn, http.client.HTTPSConnection):
+            fileno = get_sendfile_fileno(fp)
+        if fileno != -1:
+            if conn.sock is None:
+                conn.connect()
+            while totallen < length:
+                sent = conn.sock.sendfile(fp, offset + totallen, min(self.SendFileSliceSize, length - totallen))
+                if sent <= 0:
+                    break
+                totallen += sent
+                if self.show_bar:
+                    self.view_bar(totallen, length)
+        elif hasattr(fp, 'readinto'):
+            fp.seek(offset)
+            view = memoryview(self._get_send_buffer())
+            while totallen < length:
+                read_len = fp.readinto(view[:min(len(view), length - totallen)])
+                if not read_len:
+                    break
+                if hasher is not None:
+                    hasher.update(view[:read_len])
+                conn.send(view[:read_len])
+                totallen += read_len
+                if self.show_bar:
+                    self.view_bar(totallen, length)
+        else:
+            fp.seek(offset)
+            while totallen < length:
+                data = fp.read(min(self.SendBufferSize, length - totallen))
+                if not data:
+                    break
+                if hasher is not None:
+                    hasher.update(data)
+                conn.send(data)
+                totallen += len(data)
+                if self.show_bar:
+                    self.view_bar(totallen, length)
+        if totallen < length:
+            raise IOError("only %s of %s bytes could be read from the file to upload" % (totallen, length))
+        return totallen
+
+    def put_object_from_fp(self, bucket, object, fp, content_type=DefaultContentType, headers=None, params=None, compression=None):
         '''
         Put object into bucket, the content of object is read from file pointer
 
@@ -685,42 +1094,133 @@ class OssAPI:
         :type headers: dict
         :param: HTTP header
 
+        :type compression: string
+        :param: "gzip" or "zstd" to compress the content while it is sent,
+                see put_object_from_stream
+
         Returns:
             HTTP Response
         '''
-        tmp_object = object
-        tmp_headers = {}
-        tmp_params = {}
-        if headers and isinstance(headers, dict):
-            tmp_headers = headers.copy()
-        if params and isinstance(params, dict):
-            tmp_params = params.copy()
+        if compression:
+            return self.put_object_from_stream(bucket, object, fp, content_type, headers, params, compression)
+        host = self.get_host(bucket)
+        retry = self.retry_policy.start()
+        while True:
+            tmp_headers = HeaderMap(headers)
+            tmp_params = {}
+            if params and isinstance(params, dict):
+                tmp_params = params.copy()
+
+            fp.seek(os.SEEK_SET, os.SEEK_END)
+            filesize = fp.tell()
+            fp.seek(os.SEEK_SET)
+            conn = None
+            try:
+                conn = self._open_conn_to_put_object(bucket, object, filesize, content_type, tmp_headers, tmp_params, host)
+                self._send_file_range(conn, fp, 0, filesize)
+                res = conn.getresponse()
+            except Exception as e:
+                if conn is not None:
+                    conn.close()
+                if retry.should_retry(error=e):
+                    retry.sleep()
+                    continue
+                raise
+            if res.status == 301 or res.status == 302:
+                host = self._redirect_host(res, bucket, host)
+                continue
+            if retry.should_retry(status=res.status):
+                res.read()
+                retry.sleep()
+                continue
+            return res
 
-        fp.seek(os.SEEK_SET, os.SEEK_END)
-        filesize = fp.tell()
-        fp.seek(os.SEEK_SET)
-        conn = self._open_conn_to_put_object(bucket, object, filesize, content_type, headers, params)
+    def _send_chunked(self, conn, reader):
+        '''
+        NOT public API
+        Send everything reader.read() returns with chunked transfer encoding.
+        '''
         totallen = 0
-        l = fp.read(self.SendBufferSize)
-        retry_times = 0
-        while len(l) > 0:
-            if retry_times > 100:
-                raise Exception('retry too many times')
+        while True:
+            data = reader.read()
+            if not data:
+                break
+            conn.send(b"%x\r\n" % len(data))
+            conn.send(data)
+            conn.send(b"\r\n")
+            totallen += len(data)
+        conn.send(b"0\r\n\r\n")
+        return totallen
+
+    def put_object_from_stream(self, bucket, object, fp, content_type=DefaultContentType, headers=None, params=None, compression=None):
+        '''
+        Put object into bucket, the content is read from fp until its end and
+        sent with chunked transfer encoding, so its size need not be known.
+        With compression ("gzip" or "zstd") the content is compressed on the
+        fly, only SendBufferSize bytes of fp are held at a time, and
+        Content-Encoding is set. The request is only retried if fp can seek.
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type fp: file
+        :param: binary file object to read
+
+        :type content_type: string
+        :param: the object content type that supported by HTTP
+
+        :type headers: dict
+        :param: HTTP header
+
+        :type compression: string
+        :param
+
+        Returns:
+            HTTP Response
+        '''
+        host = self.get_host(bucket)
+        retry = self.retry_policy.start()
+        try:
+            start_pos = fp.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            start_pos = None
+        is_first = True
+        while True:
+            tmp_headers = HeaderMap(headers)
+            tmp_params = {}
+            if params and isinstance(params, dict):
+                tmp_params = params.copy()
+            if compression:
+                tmp_headers['Content-Encoding'] = compression
+            if not is_first:
+                fp.seek(start_pos)
+            is_first = False
+            reader = CompressedReader(fp, compression, self.SendBufferSize)
+            conn = None
             try:
-                conn.send(l)
-                retry_times = 0
-            except:
-                retry_times += 1
+                conn = self._open_conn_to_put_object(bucket, object, None, content_type, tmp_headers, tmp_params, host)
+                self._send_chunked(conn, reader)
+                res = conn.getresponse()
+            except Exception as e:
+                if conn is not None:
+                    conn.close()
+                if start_pos is not None and retry.should_retry(error=e):
+                    retry.sleep()
+                    continue
+                raise
+            if res.status == 301 or res.status == 302:
+                if start_pos is None:
+                    return res
+                host = self._redirect_host(res, bucket, host)
                 continue
-            totallen += len(l)
-            if self.show_bar:
-                self.view_bar(totallen, filesize)
-            l = fp.read(self.SendBufferSize)
-        res = conn.getresponse()
-        if res.status == 301 or res.status == 302:
-            self.host = helper_get_host_from_resp(res, bucket)
-            return self.put_object_from_fp(bucket, tmp_object, fp, content_type, tmp_headers, tmp_params)
-        return res
+            if start_pos is not None and retry.should_retry(status=res.status):
+                res.read()
+                retry.sleep()
+                continue
+            return res
 
     def get_object(self, bucket, object, headers=None, params=None):
         '''
@@ -742,7 +1242,27 @@ class OssAPI:
         body = ''
         return self.http_request(method, bucket, object, headers, body, params)
 
-    def get_object_to_file(self, bucket, object, filename, headers=None):
+    def get_object_stream(self, bucket, object, headers=None, params=None):
+        '''
+        Get object as a file-like DecodingReader that decodes a gzip or zstd
+        Content-Encoding while it is read.
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type headers: dict
+        :param: HTTP header
+
+        Returns:
+            DecodingReader, its response is the HTTP Response
+        '''
+        res = self.get_object(bucket, object, headers, params)
+        return DecodingReader(res, self.RecvBufferSize)
+
+    def get_object_to_file(self, bucket, object, filename, headers=None, decompress=False, checkpoint_dir=None):
         '''
         Get object and write the content of object into a file
 
@@ -758,29 +1278,204 @@ class OssAPI:
         :type headers: dict
         :param: HTTP header
 
+        :type decompress: bool
+        :param: decode a gzip or zstd Content-Encoding while writing
+
+        :type checkpoint_dir: string
+        :param: make the download resumable, see get_object_to_file_parallel
+                which is used with one thread then; the response returned is
+                the one of the HEAD request. It can not be combined with
+                decompress.
+
         Returns:
             HTTP Response
         '''
+        if checkpoint_dir:
+            if decompress:
+                raise ValueError("decompress can not be combined with checkpoint_dir")
+            return self.get_object_to_file_parallel(bucket, object, filename, 1, DEFAULT_PART_SIZE, headers, checkpoint_dir)
         res = self.get_object(bucket, object, headers)
         totalread = 0
-        if res.status / 100 == 2:
-            header = {}
-            header = convert_header2map(res.getheaders())
-            filesize = safe_get_element("content-length", header)
+        if res.status // 100 == 2:
+            filesize = get_header_map(res).get("content-length", "")
             with open(filename, 'wb') as f:
-                data = ''
-                while True:
-                    data = res.read(self.RecvBufferSize)
-                    if data:
+                if decompress:
+                    reader = DecodingReader(res, self.RecvBufferSize)
+                    while True:
+                        data = reader.read(self.RecvBufferSize)
+                        if not data:
+                            break
                         f.write(data)
-                        totalread += len(data)
-                        if self.show_bar:
-                            self.view_bar(totalread, filesize)
-                    else:
-                        break
+                else:
+                    buf = self.buffer_pool.get(self.RecvBufferSize)
+                    try:
+                        view = memoryview(buf)[:self.RecvBufferSize]
+                        while True:
+                            n = res.readinto(view)
+                            if not n:
+                                break
+                            f.write(view[:n])
+                            totalread += n
+                            if self.show_bar:
+                                self.view_bar(totalread, filesize)
+                    finally:
+                        self.buffer_pool.put(buf)
         # TODO: get object with flow
         return res
 
+    def get_object_reader(self, bucket, object, block_size=1024*1024, read_ahead=4, thread_num=2, headers=None):
+        '''
+        Open object as a seekable file-like OssObjectReader, see its doc.
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type block_size: int
+        :param: size of each ranged GET
+
+        :type read_ahead: int
+        :param: blocks prefetched ahead of a sequential reader, 0 for none
+
+        :type thread_num: int
+        :param: threads fetching the blocks
+
+        :type headers: dict
+        :param: HTTP header
+
+        Returns:
+            OssObjectReader
+        '''
+        return OssObjectReader(self, bucket, object, block_size, read_ahead, thread_num, headers)
+
+    def get_ranges(self, bucket, object, range_list, max_gap=64*1024, max_request_size=8*1024*1024, thread_num=10, headers=None):
+        '''
+        Read many byte ranges of object. Ranges less than max_gap bytes apart
+        are merged into one ranged GET of at most max_request_size bytes
+        (see coalesce_ranges), and the merged requests are sent by thread_num
+        threads at a time.
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type range_list: list
+        :param: list of (offset, length)
+
+        :type max_gap: int
+        :param: most bytes read and thrown away between two merged ranges
+
+        :type max_request_size: int
+        :param
+
+        :type thread_num: int
+        :param
+
+        :type headers: dict
+        :param: HTTP header, e.g. If-Match
+
+        Returns:
+            list of memoryview, one per range of range_list in the same
+            order, views of the buffer of their merged request; a view is
+            shorter than asked at the end of the object
+        '''
+        result_list = [memoryview(b"")] * len(range_list)
+        request_list = [request for request in coalesce_ranges(range_list, max_gap, max_request_size) if request[1] > request[0]]
+
+        def get_request(request):
+            (start, end, index_list) = request
+            buf = bytearray(end - start)
+            got = get_range_into(self, bucket, object, start, buf, headers)
+            view = memoryview(buf)[:got]
+            for index in index_list:
+                (offset, length) = range_list[index]
+                result_list[index] = view[offset - start:offset - start + length]
+
+        if len(request_list) == 1:
+            get_request(request_list[0])
+        elif request_list:
+            with concurrent.futures.ThreadPoolExecutor(min(thread_num, len(request_list))) as executor:
+                for future in [executor.submit(get_request, request) for request in request_list]:
+                    future.result()
+        return result_list
+
+    def get_object_to_file_parallel(self, bucket, object, filename, thread_num=10, part_size=DEFAULT_PART_SIZE, headers=None, checkpoint_dir=None):
+        '''
+        Get object into a file with thread_num ranged GETs at a time. The
+        file is preallocated to the size given by HEAD and each range is
+        written at its offset by MultiGetWorker. The ranges are fetched with
+        If-Match so the object can not change during the download.
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type filename: string
+        :param
+
+        :type thread_num: int
+        :param
+
+        :type part_size: int
+        :param: size of each ranged GET
+
+        :type headers: dict
+        :param: HTTP header
+
+        :type checkpoint_dir: string
+        :param: directory of the DownloadCheckpoint journals. The ranges
+                already written by an interrupted download of the same
+                version of the object are not fetched again. The journal is
+                removed when the download completes.
+
+        Returns:
+            HTTP Response of the HEAD request
+        '''
+        res = self.head_object(bucket, object, headers)
+        res.read()
+        if res.status != 200:
+            return res
+        header_map = get_header_map(res)
+        size = int(header_map.get("content-length", "0"))
+        etag = header_map.get("etag", "")
+        last_modified = header_map.get("last-modified", "")
+        range_headers = HeaderMap(headers)
+        if etag:
+            range_headers['If-Match'] = etag
+        checkpoint = None
+        if checkpoint_dir:
+            checkpoint = DownloadCheckpoint(checkpoint_dir, bucket, object, filename)
+            if checkpoint.load(etag, last_modified, size):
+                part_size = checkpoint.part_size
+            else:
+                checkpoint.start(etag, last_modified, size, part_size)
+        range_list = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        if checkpoint is not None:
+            range_list = [item for item in range_list if item not in checkpoint.done_range_set]
+        fd = open_preallocated_file(filename, size)
+        try:
+            if hasattr(os, 'pwrite'):
+                create_worker = lambda range_queue: MultiGetWorker(self, bucket, object, fd, 0, 0, self.retry_times, range_queue, range_headers, checkpoint)
+            else:
+                create_worker = lambda range_queue: MultiGetWorker(self, bucket, object, open(filename, 'r+b'), 0, 0, self.retry_times, range_queue, range_headers, checkpoint)
+            failed_part_list = []
+            if range_list:
+                failed_part_list = run_part_workers(create_worker, range_list, thread_num)
+        finally:
+            os.close(fd)
+        if failed_part_list:
+            raise Exception("-2, get /%s/%s to %s failed! failed ranges: %s" % (bucket, object, filename,
+                            ", ".join("%s-%s(%s)" % (part[0], part[1], reason) for part, reason in failed_part_list)))
+        if checkpoint is not None:
+            checkpoint.remove()
+        return res
+
     def delete_object(self, bucket, object, headers=None):
         '''
         Delete object
@@ -851,11 +1546,10 @@ class OssAPI:
             HTTP Response
         '''
         method = 'POST'
-        if not headers:
-            headers = {}
+        headers = HeaderMap(headers)
         if not params:
             params = {}
-        if not headers.has_key('Content-Type'):
+        if 'Content-Type' not in headers:
             content_type = get_content_type_by_filename(object)
             headers['Content-Type'] = content_type
         body = object_group_msg_xml
@@ -887,15 +1581,15 @@ class OssAPI:
         params = {}
         return self.http_request(method, bucket, object, headers, body, params)
 
-    def upload_part_from_file_given_pos(self, bucket, object, filename, offset, partsize, upload_id, part_number, headers=None, params=None):
+    def upload_part_from_file_given_pos(self, bucket, object, filename, offset, partsize, upload_id, part_number, headers=None, params=None, hash_content=False):
         if not params:
             params = {}
         params['partNumber'] = part_number
         params['uploadId'] = upload_id
         content_type = ''
-        return self.put_object_from_file_given_pos(bucket, object, filename, offset, partsize, content_type, headers, params)
+        return self.put_object_from_file_given_pos(bucket, object, filename, offset, partsize, content_type, headers, params, hash_content)
 
-    def put_object_from_file_given_pos(self, bucket, object, filename, offset, partsize, content_type='', headers=None, params=None):
+    def put_object_from_file_given_pos(self, bucket, object, filename, offset, partsize, content_type='', headers=None, params=None, hash_content=False):
         '''
         Put object into bucket, the content of object is read from given posision of filename
         :type bucket: string
@@ -919,46 +1613,54 @@ class OssAPI:
         :type headers: dict
         :param: HTTP header
 
+        :type hash_content: bool
+        :param: compute the md5 of the content while it is sent, the hex
+                digest is set as content_md5 of the returned response. It is
+                only done when the content goes through the send buffer
+                anyway; a range sent by os.sendfile is not hashed and
+                content_md5 is left unset.
+
         Returns:
             HTTP Response
         '''
-        tmp_object = object
-        tmp_headers = {}
-        tmp_params = {}
-        if headers and isinstance(headers, dict):
-            tmp_headers = headers.copy()
-        if params and isinstance(params, dict):
-            tmp_params = params.copy()
-
-        fp = open(filename, 'rb')
-        if offset > os.path.getsize(filename):
-            fp.seek(os.SEEK_SET, os.SEEK_END)
-        else:
-            fp.seek(offset)
         if not content_type:
             content_type = get_content_type_by_filename(filename)
-        conn = self._open_conn_to_put_object(bucket, object, partsize, content_type, headers, params)
-        left_len = partsize
+        host = self.get_host(bucket)
+        retry = self.retry_policy.start()
         while True:
-            if left_len <= 0:
-                break
-            elif left_len < self.SendBufferSize:
-                buffer_content = fp.read(left_len)
-            else:
-                buffer_content = fp.read(self.SendBufferSize)
-
-            if buffer_content:
-                conn.send(buffer_content)
-
-            left_len = left_len - len(buffer_content)
+            tmp_headers = HeaderMap(headers)
+            tmp_params = {}
+            if params and isinstance(params, dict):
+                tmp_params = params.copy()
 
-        fp.close()
-        res = conn.getresponse()
-        if res.status == 301 or res.status == 302:
-            self.host = helper_get_host_from_resp(res, bucket)
-            return self.put_object_from_file_given_pos(bucket, tmp_object, filename, offset, partsize
-, content_type, tmp_headers, tmp_params)
-        return res
+            fp = open(filename, 'rb')
+            conn = None
+            hasher = None
+            try:
+                conn = self._open_conn_to_put_object(bucket, object, partsize, content_type, tmp_headers, tmp_params, host)
+                if hash_content and not self._can_sendfile(conn, fp):
+                    hasher = md5()
+                self._send_file_range(conn, fp, offset, partsize, hasher)
+                res = conn.getresponse()
+            except Exception as e:
+                if conn is not None:
+                    conn.close()
+                if retry.should_retry(error=e):
+                    retry.sleep()
+                    continue
+                raise
+            finally:
+                fp.close()
+            if res.status == 301 or res.status == 302:
+                host = self._redirect_host(res, bucket, host)
+                continue
+            if retry.should_retry(status=res.status):
+                res.read()
+                retry.sleep()
+                continue
+            if hasher is not None:
+                res.content_md5 = hasher.hexdigest()
+            return res
 
     def upload_large_file(self, bucket, object, filename, thread_num=10, max_part_num=1000, headers=None):
         '''
@@ -988,39 +1690,35 @@ class OssAPI:
         '''
         #split the large file into 1000 parts or many parts
         #get part_msg_list
-        if not headers:
-            headers = {}
-        part_msg_list = split_large_file(filename, object, max_part_num)
-        #make sure all the parts are put into same bucket
-        if len(part_msg_list) < thread_num and len(part_msg_list) != 0:
-            thread_num = len(part_msg_list)
-        step = len(part_msg_list) / thread_num
+        headers = HeaderMap(headers)
+        #the md5 of each part is computed while it is uploaded
+        #the part objects of an earlier run are only reused if the parts
+        #have the same boundaries, so the part size must not depend on the
+        #measured throughput here
+        part_msg_list = list(plan_large_file(filename, object, max_part_num, DEFAULT_PART_SIZE))
+        if self.hash_index is not None:
+            file_stat = self.hash_index.get_stat(filename)
+            part_msg_list = fill_part_md5_from_index(self.hash_index, filename, part_msg_list)
+        part_md5_map = {}
+        #the parts are consumed from one queue, a failed part is retried alone
+        pending_part_list = part_msg_list
         retry_times = self.retry_times
-        while(retry_times >= 0):
-            try:
-                threadpool = []
-                for i in xrange(0, thread_num):
-                    if i == thread_num - 1:
-                        end = len(part_msg_list)
-                    else:
-                        end = i * step + step
-                    begin = i * step
-                    oss = OssAPI(self.host, self.access_id, self.secret_access_key)
-                    current = PutObjectGroupWorker(oss, bucket, filename, part_msg_list[begin:end], self.retry_times)
-                    threadpool.append(current)
-                    current.start()
-                for item in threadpool:
-                    item.join()
+        while True:
+            failed_part_list = run_part_workers(lambda part_queue: PutObjectGroupWorker(self, bucket, filename, part_queue, self.retry_times, part_md5_map), pending_part_list, thread_num)
+            if not failed_part_list:
                 break
-            except:
-                retry_times = retry_times -1
-        if -1 >= retry_times:
-            print("after retry %s, failed, upload large file failed!" % retry_times)
-            return
+            retry_times -= 1
+            if retry_times < 0:
+                print("after retry %s, failed, upload large file failed! failed parts: %s" % (self.retry_times, format_failed_parts(failed_part_list)))
+                return
+            pending_part_list = [part for part, reason in failed_part_list]
         #get xml string that contains msg of object group
+        part_msg_list = fill_part_md5(part_msg_list, part_md5_map)
+        if self.hash_index is not None and part_msg_list:
+            self.hash_index.put(filename, [part[2] for part in part_msg_list], part_msg_list[0][3], file_stat)
         object_group_msg_xml = create_object_group_msg_xml(part_msg_list)
         content_type = get_content_type_by_filename(filename)
-        if not headers.has_key('Content-Type'):
+        if 'Content-Type' not in headers:
             headers['Content-Type'] = content_type
         return self.post_object_group(bucket, object, object_group_msg_xml, headers)
 
@@ -1192,6 +1890,35 @@ class OssAPI:
         content_type = ''
         return self.put_object_from_file(bucket, object, filename, content_type, headers, params)
 
+    def upload_part_from_bytes(self, bucket, object, data, upload_id, part_number, headers=None, params=None):
+        '''
+        Upload the content of bytes as one part of given upload_id
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type data: bytes-like
+        :param: any buffer accepted by put_object_from_buffer
+
+        :type upload_id: string
+        :param
+
+        :type part_number: int
+        :param
+
+        Returns:
+            HTTP Response
+        '''
+        if not params:
+            params = {}
+        params['partNumber'] = part_number
+        params['uploadId'] = upload_id
+        content_type = ''
+        return self.put_object_from_buffer(bucket, object, data, content_type, headers, params)
+
     def upload_part_from_string(self, bucket, object, data, upload_id, part_number, headers=None, params=None):
         '''
         Upload the content of string as one part of given upload_id
@@ -1220,13 +1947,7 @@ class OssAPI:
         Returns:
             HTTP Response
         '''
-        if not params:
-            params = {}
-        params['partNumber'] = part_number
-        params['uploadId'] = upload_id
-        content_type = ''
-        fp = io.StringIO(data)
-        return self.put_object_from_fp(bucket, object, fp, content_type, headers, params)
+        return self.upload_part_from_bytes(bucket, object, data, upload_id, part_number, headers, params)
 
     def complete_upload(self, bucket, object, upload_id, part_msg_xml, headers=None, params=None):
         '''
@@ -1253,15 +1974,14 @@ class OssAPI:
         Returns:
             HTTP Response
         '''
-        if not headers:
-            headers = {}
+        headers = HeaderMap(headers)
         if not params:
             params = {}
         method = 'POST'
         body = part_msg_xml
         headers['Content-Length'] = str(len(body))
         params['uploadId'] = upload_id
-        if not headers.has_key('Content-Type'):
+        if 'Content-Type' not in headers:
             content_type = get_content_type_by_filename(object)
             headers['Content-Type'] = content_type
         return self.http_request(method, bucket, object, headers, body, params)
@@ -1294,7 +2014,7 @@ class OssAPI:
         body = ''
         return self.http_request(method, bucket, object, headers, body, params)
 
-    def multi_upload_file(self, bucket, object, filename, upload_id='', thread_num=10, max_part_num=10000, headers=None, params=None):
+    def multi_upload_file(self, bucket, object, filename, upload_id='', thread_num=10, max_part_num=10000, headers=None, params=None, part_size=0, checkpoint_dir=None, compression=None):
         '''
         Upload large file, the content is read from filename. The large file is splitted into many parts. It will        put the many parts into bucket and then merge all the parts into one object.
 
@@ -1322,10 +2042,42 @@ class OssAPI:
         :type params: dict
         :param
 
+        :type part_size: int
+        :param: 0 lets plan_part_size pick it from the file size, thread_num
+                and the throughput measured on earlier parts for a new
+                upload; when upload_id is given it is taken from the parts
+                already uploaded so that they are reused. A given size is
+                kept within MIN_PART_SIZE, MAX_PART_SIZE and max_part_num.
+
+        :type checkpoint_dir: string
+        :param: directory of the UploadCheckpoint journals. If a journal of
+                this file is found there the upload resumes from it without
+                listing parts or hashing the file, otherwise a new one is
+                written and it is removed when the upload completes.
+
+        :type compression: string
+        :param: "gzip" or "zstd" to upload the compressed content with
+                multi_upload_stream, which can not be resumed: it can not
+                be combined with upload_id or checkpoint_dir
+
         Returns:
             HTTP Response
         '''
+        if compression:
+            if upload_id or checkpoint_dir:
+                raise ValueError("compression can not be combined with upload_id or checkpoint_dir")
+            with open(filename, 'rb') as fp:
+                return self.multi_upload_stream(bucket, object, fp, part_size or DEFAULT_PART_SIZE, thread_num, headers, params, compression)
+        checkpoint = None
+        is_resumed = False
+        if checkpoint_dir:
+            checkpoint = UploadCheckpoint(checkpoint_dir, bucket, object, filename)
+            if checkpoint.load() and upload_id in ('', checkpoint.upload_id):
+                upload_id = checkpoint.upload_id
+                part_size = checkpoint.part_size
+                is_resumed = True
         #get init upload_id
+        is_new_upload = not upload_id
         if not upload_id:
             res = self.init_multi_upload(bucket, object, headers, params)
             body = res.read()
@@ -1339,53 +2091,322 @@ class OssAPI:
             raise Exception("-1, Cannot get upload id.")
         #split the large file into 1000 parts or many parts
         #get part_msg_list
-        part_msg_list = split_large_file(filename, object, max_part_num)
+        #the md5 of each part is computed while it is uploaded
+        if is_resumed:
+            part_msg_list = checkpoint.part_msg_list
+            part_md5_map = checkpoint.part_md5_map.copy()
+        else:
+            if not part_size and not is_new_upload:
+                #keep the layout of the parts already uploaded
+                part_size = get_upload_part_size(get_part_list(self, bucket, object, upload_id))
+            elif not part_size:
+                part_size, thread_num = plan_part_size(os.path.getsize(filename), thread_num, max_part_num, self.throughput_meter.get())
+            else:
+                part_size = clamp_part_size(part_size, os.path.getsize(filename), max_part_num)
+            part_msg_list = list(plan_large_file(filename, object, max_part_num, part_size))
+            part_md5_map = {}
+            if checkpoint is not None:
+                checkpoint.start(upload_id, part_size, part_msg_list)
+        if self.hash_index is not None:
+            file_stat = self.hash_index.get_stat(filename)
+            part_msg_list = fill_part_md5_from_index(self.hash_index, filename, part_msg_list)
         logger = getlogger(self.debug)
-        logger.info("bucket:%s, object:%s, upload_id is: %s, split_number:%d" % (bucket, object, upload_id, len(part_msg_list)))
-
-        #make sure all the parts are put into same bucket
-        if len(part_msg_list) < thread_num and len(part_msg_list) != 0:
-            thread_num = len(part_msg_list)
-        step = len(part_msg_list) / thread_num
+        logger.info("bucket:%s, object:%s, upload_id is: %s, split_number:%d, part_size:%d, thread_num:%d" % (bucket, object, upload_id, len(part_msg_list), part_size, thread_num))
 
         #list part to get a map
         upload_retry_times = self.retry_times
         while(upload_retry_times >= 0):
             uploaded_part_map = {}
-            oss = OssAPI(self.host, self.access_id, self.secret_access_key)
-            uploaded_part_map = get_part_map(oss, bucket, object, upload_id)
+            #the journal already tells which parts are done
+            if not is_resumed or upload_retry_times < self.retry_times:
+                uploaded_part_map = get_part_map(self, bucket, object, upload_id)
+            #the parts are consumed from one queue, a failed part is retried alone
+            pending_part_list = part_msg_list
             retry_times = self.retry_times
-            while(retry_times >= 0):
-                threadpool = []
-                try:
-                    for i in xrange(0, thread_num):
-                        if i == thread_num - 1:
-                            end = len(part_msg_list)
-                        else:
-                            end = i * step + step
-                        begin = i * step
-                        oss = OssAPI(self.host, self.access_id, self.secret_access_key)
-                        current = UploadPartWorker(oss, bucket, object, upload_id, filename, part_msg_list[begin:end], uploaded_part_map, self.retry_times)
-                        threadpool.append(current)
-                        current.start()
-                    for item in threadpool:
-                        item.join()
+            while True:
+                failed_part_list = run_part_workers(lambda part_queue: UploadPartWorker(self, bucket, object, upload_id, filename, part_queue, uploaded_part_map, self.retry_times, self.debug, part_md5_map, checkpoint), pending_part_list, thread_num)
+                if not failed_part_list:
                     break
-                except:
-                    retry_times -= 1
-            if -1 >= retry_times:
-                raise Exception("-2, after retry %s, failed, multi upload part failed! upload_id:%s" % (self.retry_times, upload_id))
+                retry_times -= 1
+                if retry_times < 0:
+                    if is_resumed and all(reason == 404 for part, reason in failed_part_list):
+                        #the upload_id of the journal is gone, start over next time
+                        checkpoint.remove()
+                    raise Exception("-2, after retry %s, failed, multi upload part failed! upload_id:%s, failed parts: %s" % (self.retry_times, upload_id, format_failed_parts(failed_part_list)))
+                logger.warn("upload_id:%s, retry failed parts: %s" % (upload_id, format_failed_parts(failed_part_list)))
+                pending_part_list = [part for part, reason in failed_part_list]
             #get xml string that contains msg of part
-            part_msg_xml = create_part_xml(part_msg_list)
+            done_part_list = fill_part_md5(part_msg_list, part_md5_map)
+            part_msg_xml = create_part_xml(done_part_list)
             #complete upload
             res = self.complete_upload(bucket, object, upload_id, part_msg_xml, headers, params)
             if res.status == 200:
+                if checkpoint is not None:
+                    checkpoint.remove()
+                if self.hash_index is not None and done_part_list:
+                    self.hash_index.put(filename, [part[2] for part in done_part_list], done_part_list[0][3], file_stat)
                 break
             upload_retry_times -= 1
         if upload_retry_times < 0:
             raise Exception("-3, after retry %s, failed, multi upload file failed! upload_id:%s" % (self.retry_times, upload_id))
         return res
 
+    def multi_upload_stream(self, bucket, object, fp, part_size=DEFAULT_PART_SIZE, thread_num=10, headers=None, params=None, compression=None):
+        '''
+        Multipart upload of everything read from fp, whose size need not be
+        known. Parts are cut while reading and uploaded by thread_num
+        threads; at most thread_num parts wait in memory. The parts are of
+        part_size bytes, doubled every 1000 parts (see get_stream_part_size)
+        so a long stream stays within MAX_PART_NUM parts. With
+        compression ("gzip" or "zstd") the content is compressed on the fly
+        and Content-Encoding is set.
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type fp: file
+        :param: binary file object to read
+
+        :type part_size: int
+        :param
+
+        :type thread_num: int
+        :param
+
+        :type headers: dict
+        :param
+
+        :type params: dict
+        :param
+
+        :type compression: string
+        :param
+
+        Returns:
+            HTTP Response
+        '''
+        init_headers = HeaderMap(headers)
+        if compression:
+            init_headers['Content-Encoding'] = compression
+        upload_id = self._init_upload_id(bucket, object, init_headers, params)
+        part_md5_map = {}
+        create_worker = lambda part_queue: UploadDataPartWorker(self, bucket, object, upload_id, part_queue, self.retry_times, self.debug, part_md5_map)
+        part_queue, threadpool = start_part_workers(create_worker, thread_num, thread_num)
+        part_order = 1
+        part_sizes = {}
+        reader = CompressedReader(fp, compression, self.SendBufferSize)
+        buf = bytearray()
+        try:
+            while True:
+                data = reader.read()
+                if data:
+                    buf += data
+                while True:
+                    cur_part_size = get_stream_part_size(part_size, part_order)
+                    if not (len(buf) >= cur_part_size or (not data and (buf or part_order == 1))):
+                        break
+                    if part_order > MAX_PART_NUM:
+                        raise Exception("-2, the stream needs more than %d parts, upload_id:%s" % (MAX_PART_NUM, upload_id))
+                    part_data = bytes(buf[:cur_part_size])
+                    del buf[:cur_part_size]
+                    part_sizes[part_order] = len(part_data)
+                    part_queue.put((part_order, part_data))
+                    part_order += 1
+                if not data:
+                    break
+        finally:
+            failed_part_list = join_part_workers(part_queue, threadpool)
+        return self._complete_data_upload(bucket, object, upload_id, create_worker, failed_part_list, part_md5_map, part_sizes, thread_num, headers, params)
+
+    def multi_upload_buffer(self, bucket, object, buffer, thread_num=10, part_size=0, headers=None, params=None):
+        '''
+        Multipart upload of a large in-memory buffer. The buffer is cut into
+        memoryview parts that are hashed and uploaded by thread_num threads,
+        nothing is copied or written to disk.
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type buffer: bytes-like
+        :param: any buffer accepted by put_object_from_buffer
+
+        :type thread_num: int
+        :param
+
+        :type part_size: int
+        :param: 0 lets plan_part_size pick it
+
+        :type headers: dict
+        :param
+
+        :type params: dict
+        :param
+
+        Returns:
+            HTTP Response
+        '''
+        view = get_byte_view(buffer)
+        length = view.nbytes
+        if not part_size:
+            part_size, thread_num = plan_part_size(length, thread_num, MAX_PART_NUM, self.throughput_meter.get())
+        part_size = clamp_part_size(part_size, length)
+        upload_id = self._init_upload_id(bucket, object, headers, params)
+        part_list = []
+        part_sizes = {}
+        for offset in range(0, max(length, 1), part_size):
+            part_order = len(part_list) + 1
+            part_list.append((part_order, view[offset:offset + part_size]))
+            part_sizes[part_order] = min(part_size, length - offset)
+        part_md5_map = {}
+        create_worker = lambda part_queue: UploadDataPartWorker(self, bucket, object, upload_id, part_queue, self.retry_times, self.debug, part_md5_map)
+        failed_part_list = run_part_workers(create_worker, part_list, thread_num)
+        return self._complete_data_upload(bucket, object, upload_id, create_worker, failed_part_list, part_md5_map, part_sizes, thread_num, headers, params)
+
+    def _init_upload_id(self, bucket, object, headers=None, params=None):
+        '''
+        NOT public API
+        Init a multipart upload and return its upload_id.
+        '''
+        res = self.init_multi_upload(bucket, object, headers, dict(params or {}))
+        body = res.read()
+        if res.status != 200:
+            err = ErrorXml(body)
+            raise Exception("%s, %s" %(res.status, err.msg))
+        upload_id = GetInitUploadIdXml(body).upload_id
+        if not upload_id:
+            raise Exception("-1, Cannot get upload id.")
+        return upload_id
+
+    def _complete_data_upload(self, bucket, object, upload_id, create_worker, failed_part_list, part_md5_map, part_sizes, thread_num, headers=None, params=None):
+        '''
+        NOT public API
+        Upload again the failed parts of an UploadDataPartWorker upload, then
+        complete it.
+        '''
+        logger = getlogger(self.debug)
+        retry_times = self.retry_times
+        while failed_part_list:
+            retry_times -= 1
+            if retry_times < 0:
+                raise Exception("-2, after retry %s, failed, multi upload part failed! upload_id:%s, failed parts: %s" % (self.retry_times, upload_id, format_failed_parts(failed_part_list)))
+            logger.warn("upload_id:%s, retry failed parts: %s" % (upload_id, format_failed_parts(failed_part_list)))
+            failed_part_list = run_part_workers(create_worker, [part for part, reason in failed_part_list], thread_num)
+        part_msg_list = [(order, "", part_md5_map[order], part_sizes[order], 0) for order in sorted(part_sizes)]
+        part_msg_xml = create_part_xml(part_msg_list)
+        retry = self.retry_policy.start()
+        while True:
+            res = self.complete_upload(bucket, object, upload_id, part_msg_xml, headers, params)
+            if res.status != 200 and retry.should_retry(status=res.status):
+                res.read()
+                retry.sleep()
+                continue
+            return res
+
+    def sync_directory(self, local_dir, bucket, prefix='', thread_num=10, multipart_threshold=100*1024*1024, part_thread_num=0, headers=None, checkpoint_dir=None, progress_callback=None):
+        '''
+        Upload the files under local_dir that are missing or changed in bucket.
+        The file local_dir/a/b is put as object prefix + "a/b". The tree is
+        walked lazily and merged with a streamed listing of prefix, files are
+        compared by size and md5 (see is_file_changed) and uploaded by a
+        pool of thread_num threads. Files of multipart_threshold bytes or
+        more are uploaded by multi_upload_file.
+        thread_num is also the budget of connections shared by all the
+        files: a small file uses one, a multipart upload takes the ones
+        free when it starts, from 1 up to part_thread_num, so at most
+        thread_num uploads run at any time.
+
+        :type local_dir: string
+        :param
+
+        :type bucket: string
+        :param
+
+        :type prefix: string
+        :param: prefix of the object names
+
+        :type thread_num: int
+        :param: number of files, and of connections, uploading at the same time
+
+        :type multipart_threshold: int
+        :param
+
+        :type part_thread_num: int
+        :param: most threads of one multipart upload, 0 for thread_num; it
+                only gets the connections of the budget free when it starts
+
+        :type headers: dict
+        :param: HTTP header of every upload
+
+        :type checkpoint_dir: string
+        :param: passed to multi_upload_file
+
+        :type progress_callback: function
+        :param: called with the SyncProgress after each file
+
+        Returns:
+            SyncProgress
+        '''
+        if not part_thread_num:
+            part_thread_num = thread_num
+        logger = getlogger(self.debug)
+        progress = SyncProgress(progress_callback)
+        #bound the queued files so the walk stays lazy
+        slots = threading.BoundedSemaphore(thread_num * 2)
+        #connections of all the uploads, shared by the files
+        connections = threading.Semaphore(thread_num)
+
+        def sync_file(object, file_path, file_stat, object_meta):
+            try:
+                if object_meta is not None and not is_file_changed(file_path, file_stat, object_meta, self.hash_index):
+                    progress.add_skipped()
+                    return
+                connections.acquire()
+                connection_num = 1
+                try:
+                    if file_stat.st_size >= multipart_threshold:
+                        while connection_num < part_thread_num and connections.acquire(blocking=False):
+                            connection_num += 1
+                        res = self.multi_upload_file(bucket, object, file_path, thread_num=connection_num, headers=headers, checkpoint_dir=checkpoint_dir)
+                    else:
+                        res = self.put_object_from_file(bucket, object, file_path, headers=headers)
+                    res.read()
+                finally:
+                    for i in range(connection_num):
+                        connections.release()
+                if res.status == 200:
+                    progress.add_uploaded(file_stat.st_size)
+                else:
+                    logger.warn("sync %s to %s/%s failed! ret is:%s." % (file_path, bucket, object, res.status))
+                    progress.add_failed(file_path, res.status)
+            except Exception as e:
+                logger.warn("sync %s to %s/%s failed! error is:%r." % (file_path, bucket, object, e))
+                progress.add_failed(file_path, repr(e))
+            finally:
+                slots.release()
+
+        remote_objects = iter_bucket_objects(self, bucket, prefix)
+        object_meta = next(remote_objects, None)
+        with concurrent.futures.ThreadPoolExecutor(thread_num) as executor:
+            for relative_path, file_path, file_stat in iter_local_files(local_dir):
+                object = prefix + relative_path
+                progress.add_scanned()
+                while object_meta is not None and object_meta[0] < object:
+                    object_meta = next(remote_objects, None)
+                matched_meta = None
+                if object_meta is not None and object_meta[0] == object:
+                    matched_meta = object_meta
+                slots.acquire()
+                executor.submit(sync_file, object, file_path, file_stat, matched_meta)
+        progress.finish()
+        logger.info("sync %s to %s/%s, %s" % (local_dir, bucket, prefix, progress))
+        return progress
+
     def delete_objects(self, bucket, object_list=None, headers=None, params=None):
         '''
         Batch delete objects
@@ -1456,8 +2477,7 @@ class OssAPI:
         get_instance = GetAllObjects()
         marker_input = ''
         object_list = []
-        oss = OssAPI(self.host, self.access_id, self.secret_access_key)
-        (object_list, marker_output) = get_instance.get_object_in_bucket(oss, bucket, marker_input, prefix)
+        (object_list, marker_output) = get_instance.get_object_in_bucket(self, bucket, marker_input, prefix)
         return object_list
 
     def batch_delete_objects(self, bucket, object_list=None):
@@ -1476,7 +2496,7 @@ class OssAPI:
         object_list_xml = create_delete_object_msg_xml(object_list)
         try:
             res = self.batch_delete_object(bucket, object_list_xml)
-            if res.status / 100 == 2:
+            if res.status // 100 == 2:
                 return True
         except:
             pass
@@ -0,0 +1,654 @@
+#!/usr/bin/env python
+#coding=utf-8
+
+# Copyright (c) 2011, Alibaba Cloud Computing
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import asyncio
+import http.client
+import ssl
+import time
+import urllib
+import sys
+try:
+    from oss.oss_util import *
+except:
+    from oss_util import *
+try:
+    from oss.oss_xml_handler import *
+except:
+    from oss_xml_handler import *
+
+class AsyncConnection:
+    '''
+    One keep-alive connection of AsyncConnectionPool
+    '''
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+        self.last_used = time.time()
+
+    def is_dropped(self):
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+class AsyncConnectionPool:
+    '''
+    Per-host pool of keep-alive connections for AsyncOssAPI.
+
+    :type max_idle: int
+    :param: idle connections kept for one (host, port, scheme)
+
+    :type idle_timeout: int
+    :param: seconds an idle connection may stay in the pool
+    '''
+    def __init__(self, max_idle=100, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.ssl_context = None
+
+    async def get(self, host, port, is_security=False, timeout=10):
+        key = (host, port, is_security)
+        conn_list = self.idle.get(key)
+        now = time.time()
+        while conn_list:
+            conn = conn_list.pop()
+            if now - conn.last_used > self.idle_timeout or conn.is_dropped():
+                conn.close()
+                continue
+            conn.reused = True
+            return conn
+        ssl_context = None
+        if is_security:
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            ssl_context = self.ssl_context
+        (reader, writer) = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=ssl_context), timeout)
+        return AsyncConnection(key, reader, writer)
+
+    def put(self, conn):
+        conn_list = self.idle.setdefault(conn.key, [])
+        if len(conn_list) >= self.max_idle:
+            conn_list.pop(0).close()
+        conn.last_used = time.time()
+        conn.reused = False
+        conn_list.append(conn)
+
+    def clear(self):
+        for conn_list in self.idle.values():
+            for conn in conn_list:
+                conn.close()
+        self.idle = {}
+
+class AsyncOssResponse:
+    '''
+    Response of AsyncOssAPI. The body is not read in advance, it is streamed
+    from the socket by read() or by iterating over iter_chunks().
+    The connection goes back to the pool once the body is read to the end.
+    '''
+    def __init__(self, conn, pool, method):
+        self.conn = conn
+        self.pool = pool
+        self.method = method
+        self.status = 0
+        self.reason = ''
+        self.version = 11
+        self.headers = []
+        self.header_map = HeaderMap()
+        self.length = None
+        self.chunked = False
+        self.chunk_left = 0
+        self.will_close = False
+
+    async def begin(self):
+        reader = self.conn.reader
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("Remote end closed connection without response")
+        line = line.decode('latin-1').rstrip('\r\n')
+        status_list = line.split(None, 2)
+        if len(status_list) < 2 or not status_list[0].startswith("HTTP/"):
+            raise http.client.BadStatusLine(line)
+        if status_list[0] == "HTTP/1.0":
+            self.version = 10
+        self.status = int(status_list[1])
+        if len(status_list) == 3:
+            self.reason = status_list[2]
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            line = line.decode('latin-1')
+            index = line.find(':')
+            if index == -1:
+                continue
+            k = line[:index].strip()
+            v = line[index+1:].strip()
+            self.headers.append((k, v))
+            self.header_map[k] = v
+
+        connection = self.header_map.get('connection', '').lower()
+        if self.version == 10:
+            self.will_close = 'keep-alive' not in connection
+        else:
+            self.will_close = 'close' in connection
+        self.chunked = 'chunked' in self.header_map.get('transfer-encoding', '').lower()
+        if not self.chunked:
+            try:
+                self.length = int(self.header_map.get('content-length'))
+            except (TypeError, ValueError):
+                self.length = None
+        if self.status in (204, 304) or 100 <= self.status < 200 or self.method == 'HEAD':
+            self.length = 0
+            self.chunked = False
+        if self.length is None and not self.chunked:
+            self.will_close = True
+        if self.length == 0:
+            self._finish(True)
+
+    def getheaders(self):
+        return list(self.headers)
+
+    def getheader(self, name, default=None):
+        return self.header_map.get(name, default)
+
+    def isclosed(self):
+        return self.conn is None
+
+    async def read(self, amt=None):
+        '''
+        Read and return the response body, or up to the next amt bytes.
+        '''
+        if self.conn is None:
+            return b""
+        reader = self.conn.reader
+        try:
+            if self.chunked:
+                return await self._read_chunked(amt)
+            if self.length is None:
+                if amt is None:
+                    data = await reader.read()
+                    self._finish(False)
+                else:
+                    data = await reader.read(amt)
+                    if not data:
+                        self._finish(False)
+                return data
+            if amt is None or amt > self.length:
+                amt = self.length
+            if amt == self.length:
+                data = await reader.readexactly(amt)
+            else:
+                data = await reader.read(amt)
+                if not data:
+                    raise asyncio.IncompleteReadError(data, amt)
+            self.length -= len(data)
+            if self.length == 0:
+                self._finish(True)
+            return data
+        except:
+            self.close()
+            raise
+
+    async def _read_chunked(self, amt=None):
+        reader = self.conn.reader
+        data_list = []
+        while amt is None or amt > 0:
+            if self.chunk_left == 0:
+                line = await reader.readline()
+                self.chunk_left = int(line.split(b';', 1)[0], 16)
+                if self.chunk_left == 0:
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                    self._finish(True)
+                    break
+            read_len = self.chunk_left
+            if amt is not None and amt < read_len:
+                read_len = amt
+            data_list.append(await reader.readexactly(read_len))
+            self.chunk_left -= read_len
+            if self.chunk_left == 0:
+                await reader.readexactly(2)
+            if amt is not None:
+                break
+        return b"".join(data_list)
+
+    async def iter_chunks(self, chunk_size=64*1024):
+        '''
+        Stream the response body in chunks of at most chunk_size bytes.
+        '''
+        while True:
+            data = await self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def _finish(self, reusable):
+        conn = self.conn
+        self.conn = None
+        if conn is None:
+            return
+        if reusable and not self.will_close:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        '''
+        Drop the connection, the unread part of the body is discarded.
+        '''
+        self._finish(False)
+
+class AsyncOssAPI:
+    '''
+    An asyncio OSS API, it signs and routes requests the same way as OssAPI.
+    One instance should only be used in one event loop.
+    '''
+    DefaultContentType = 'application/octet-stream'
+    provider = PROVIDER
+    __version__ = '0.3.2'
+    Version = __version__
+    AGENT = 'oss-python%s (%s)' % (__version__, sys.platform)
+
+    def __init__(self, host, access_id, secret_access_key='', port=80, is_security=False):
+        self.host = get_second_level_domain(host)
+        self.port = port
+        self.access_id = access_id
+        self.secret_access_key = secret_access_key
+        self.is_security = is_security
+        self.retry_times = 5
+        self.retry_policy = RetryPolicy(self.retry_times)
+        self.timeout = 10
+        self.agent = self.AGENT
+        self.debug = False
+        self.signer = OssSigner(self.secret_access_key, self.debug)
+        self.conn_pool = AsyncConnectionPool()
+        self.endpoint_cache = EndpointCache()
+        self.use_bucket_location = False
+
+    def set_debug(self, is_debug):
+        if is_debug:
+            self.debug = True
+            self.signer.debug = True
+
+    def get_signer(self):
+        '''
+        Get the OssSigner of the current secret_access_key.
+        '''
+        signer = self.signer
+        if signer.secret_access_key != self.secret_access_key:
+            signer = OssSigner(self.secret_access_key, self.debug)
+            self.signer = signer
+        return signer
+
+    def set_retry_times(self, retry_times=5):
+        self.retry_times = retry_times
+        self.retry_policy.max_retries = retry_times
+
+    def set_retry_policy(self, retry_policy):
+        '''
+        Replace the RetryPolicy shared by all operations of this instance.
+        '''
+        self.retry_policy = retry_policy
+        self.retry_times = retry_policy.max_retries
+
+    def set_timeout(self, timeout=10):
+        self.timeout = timeout
+
+    def set_connection_pool(self, max_idle=100, idle_timeout=60):
+        '''
+        Replace the keep-alive connection pool, idle connections of the old one are closed.
+        '''
+        old_pool = self.conn_pool
+        self.conn_pool = AsyncConnectionPool(max_idle, idle_timeout)
+        old_pool.clear()
+
+    async def close(self):
+        '''
+        Close all idle connections kept by this instance.
+        '''
+        self.conn_pool.clear()
+
+    def set_endpoint_cache(self, ttl=3600, max_size=10000, use_bucket_location=False):
+        '''
+        Replace the per-bucket endpoint cache, see OssAPI.set_endpoint_cache.
+        '''
+        self.endpoint_cache = EndpointCache(ttl, max_size)
+        self.use_bucket_location = use_bucket_location
+
+    async def get_host(self, bucket):
+        '''
+        Get the host that requests of bucket are sent to.
+        '''
+        if not bucket:
+            return self.host
+        host = self.endpoint_cache.get(bucket)
+        if host:
+            return host
+        if self.use_bucket_location:
+            host = await self.resolve_bucket_endpoint(bucket)
+            if host:
+                return host
+        return self.host
+
+    async def resolve_bucket_endpoint(self, bucket):
+        '''
+        Get the endpoint of bucket from its location and put it into the endpoint cache.
+        A location that can not be resolved is cached as the default host, so
+        it is not asked again for every request until the entry expires.
+
+        Returns:
+            the host, or '' if it can not be resolved
+        '''
+        if is_ip(self.host):
+            return ''
+        params = {}
+        params['location'] = ''
+        host = ''
+        try:
+            res = await self.http_request_with_redirect('GET', bucket, '', {}, '', params, self.host)
+            if res.status == 301 or res.status == 302:
+                return await self._redirect_host(res, bucket, self.host)
+            body = await res.read()
+            if res.status == 200:
+                location = GetBucketLocationXml(body).location
+                host = helper_get_host_from_location(location, self.host)
+        except Exception:
+            host = ''
+        if host:
+            self.endpoint_cache.set(bucket, host)
+        else:
+            self.endpoint_cache.set(bucket, self.host)
+        return host
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def get_connection(self, tmp_host=None):
+        host = ''
+        port = 80
+        if not tmp_host:
+            tmp_host = self.host
+        host_port_list = tmp_host.split(":")
+        if len(host_port_list) == 1:
+            host = host_port_list[0].strip()
+        elif len(host_port_list) == 2:
+            host = host_port_list[0].strip()
+            port = int(host_port_list[1].strip())
+        is_security = self.is_security or port == 443
+        if is_security and len(host_port_list) == 1:
+            port = 443
+        return await self.conn_pool.get(host, port, is_security, self.timeout)
+
+    def _create_sign_for_normal_auth(self, method, headers=None, resource="/"):
+        '''
+        NOT public API
+        Create the authorization for OSS based on header input.
+        '''
+        auth_value = "%s %s:%s" % (self.provider, self.access_id, self.get_signer().sign(method, headers, resource))
+        return auth_value
+
+    async def _send_request(self, conn, method, url, body, headers):
+        '''
+        NOT public API
+        Write the request on conn and read the response head.
+        '''
+        request_lines = ["%s %s HTTP/1.1" % (method, url)]
+        for k, v in headers.items():
+            request_lines.append("%s: %s" % (k, v))
+        request_lines.append("\r\n")
+        conn.writer.write("\r\n".join(request_lines).encode('latin-1'))
+        if body:
+            conn.writer.write(body)
+        await conn.writer.drain()
+        res = AsyncOssResponse(conn, self.conn_pool, method)
+        await asyncio.wait_for(res.begin(), self.timeout)
+        return res
+
+    async def _redirect_host(self, res, bucket, host):
+        '''
+        NOT public API
+        Get the host a 301/302 response points to and remember it for bucket.
+        '''
+        new_host = helper_get_host_from_headers(res.header_map, bucket)
+        body = await res.read()
+        if not new_host:
+            new_host = RedirectXml(body).Endpoint().strip()
+            new_host = helper_get_host_from_endpoint(new_host, bucket)
+        if not new_host:
+            return host
+        if bucket:
+            self.endpoint_cache.set(bucket, new_host)
+        return new_host
+
+    async def bucket_operation(self, method, bucket, headers=None, params=None):
+        return await self.http_request(method, bucket, '', headers, '', params)
+
+    async def object_operation(self, method, bucket, object, headers=None, body='', params=None):
+        return await self.http_request(method, bucket, object, headers, body, params)
+
+    async def http_request(self, method, bucket, object, headers=None, body='', params=None):
+        '''
+        Send http request of operation, follow the redirects
+
+        :type method: string
+        :param method: one of PUT, GET, DELETE, HEAD, POST
+
+        :type bucket: string
+        :param
+
+        :type object: string
+        :param
+
+        :type headers: dict
+        :param: HTTP header
+
+        :type body: string or bytes
+        :param
+
+        Returns:
+            AsyncOssResponse
+        '''
+        redirect = 5
+        res = None
+        host = await self.get_host(bucket)
+        retry = self.retry_policy.start()
+        while redirect > 0:
+            tmp_headers = HeaderMap(headers)
+            tmp_params = {}
+            if params and isinstance(params, dict):
+                tmp_params = params.copy()
+
+            try:
+                res = await self.http_request_with_redirect(method, bucket, object, tmp_headers, body, tmp_params, host)
+            except Exception as e:
+                if self.retry_policy.is_retryable_request_error(method, e) and retry.should_retry(error=e):
+                    await asyncio.sleep(retry.next_delay())
+                    continue
+                raise
+            if res.status == 301 or res.status == 302:
+                redirect -= 1
+                host = await self._redirect_host(res, bucket, host)
+            elif self.retry_policy.is_retryable_request_status(method, res.status) and retry.should_retry(status=res.status):
+                await res.read()
+                await asyncio.sleep(retry.next_delay())
+            else:
+                return res
+        return res
+
+    async def http_request_with_redirect(self, method, bucket, object, headers=None, body='', params=None, host=None):
+        '''
+        Send http request of operation
+
+        :type method: string
+        :param method: one of PUT, GET, DELETE, HEAD, POST
+
+        :type host: string
+        :param: the host to send to, default is the host of bucket
+
+        Returns:
+            AsyncOssResponse
+        '''
+        if not params:
+            params = {}
+        if not isinstance(headers, HeaderMap):
+            headers = HeaderMap(headers)
+        if not host:
+            host = await self.get_host(bucket)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not bucket:
+            resource = "/"
+            headers['Host'] = host
+        else:
+            headers['Host'] = "%s.%s" % (bucket, host)
+            resource = "/%s/" % bucket
+        resource = "%s%s%s" % (resource, object, get_resource(params))
+        object = urllib.parse.quote(object)
+        url = "/%s" % object
+        if is_ip(host):
+            url = "/%s/%s" % (bucket, object)
+            if not bucket:
+                url = "/%s" % object
+            headers['Host'] = host
+        url = append_param(url, params)
+        date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+        headers['Date'] = date
+        headers['Authorization'] = self._create_sign_for_normal_auth(method, headers, resource)
+        headers['User-Agent'] = self.agent
+        headers['Accept-Encoding'] = 'identity'
+        if body or method in ('PUT', 'POST'):
+            headers['Content-Length'] = str(len(body))
+        if check_bucket_valid(bucket) and not is_ip(host):
+            conn_host = headers['Host']
+        else:
+            conn_host = host
+        conn = await self.get_connection(conn_host)
+        try:
+            return await self._send_request(conn, method, url, body, headers)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            conn.close()
+            if not conn.reused:
+                raise
+        except:
+            conn.close()
+            raise
+        #a pooled connection the server has closed in the meantime, retry it on a new one
+        conn = await self.get_connection(conn_host)
+        return await self._send_request(conn, method, url, body, headers)
+
+    async def get_object(self, bucket, object, headers=None, params=None):
+        '''
+        Get object, the body can be streamed by the returned response
+
+        Returns:
+            AsyncOssResponse
+        '''
+        method = 'GET'
+        body = ''
+        return await self.http_request(method, bucket, object, headers, body, params)
+
+    async def get_object_to_bytes(self, bucket, object, headers=None, params=None):
+        '''
+        Get object and read the whole content
+
+        Returns:
+            (AsyncOssResponse, bytes)
+        '''
+        res = await self.get_object(bucket, object, headers, params)
+        data = await res.read()
+        return (res, data)
+
+    async def head_object(self, bucket, object, headers=None):
+        '''
+        Head object, to get the meta message of object without the content
+
+        Returns:
+            AsyncOssResponse
+        '''
+        method = 'HEAD'
+        body = ''
+        params = {}
+        return await self.http_request(method, bucket, object, headers, body, params)
+
+    async def put_object_from_bytes(self, bucket, object, input_content, content_type=DefaultContentType, headers=None, params=None):
+        '''
+        Put object into bucket, the content of object is from input_content
+
+        :type input_content: bytes
+        :param
+
+        :type content_type: string
+        :param: the object content type that supported by HTTP
+
+        Returns:
+            AsyncOssResponse
+        '''
+        headers = HeaderMap(headers)
+        headers['Content-Type'] = content_type
+        method = 'PUT'
+        return await self.http_request(method, bucket, object, headers, input_content, params)
+
+    async def delete_object(self, bucket, object, headers=None):
+        '''
+        Delete object
+
+        Returns:
+            AsyncOssResponse
+        '''
+        method = 'DELETE'
+        body = ''
+        params = {}
+        return await self.http_request(method, bucket, object, headers, body, params)
+
+    async def list_bucket(self, bucket, prefix='', marker='', delimiter='', maxkeys='', headers=None):
+        '''
+        List object that in bucket
+
+        Returns:
+            AsyncOssResponse
+        '''
+        method = 'GET'
+        object = ''
+        body = ''
+        params = {}
+        params['prefix'] = prefix
+        params['marker'] = marker
+        params['delimiter'] = delimiter
+        params['max-keys'] = maxkeys
+        return await self.http_request(method, bucket, object, headers, body, params)
+
+    async def get_bucket(self, bucket, prefix='', marker='', delimiter='', maxkeys='', headers=None):
+        '''
+        List object that in bucket
+        '''
+        return await self.list_bucket(bucket, prefix, marker, delimiter, maxkeys, headers)
@@ -1,15 +1,28 @@
 #!/usr/bin/env python
 import urllib
 import base64
+import calendar
 import hmac
 import time
+import http.client
+import random
+import select
+import socket
+import sqlite3
+import stat
+import concurrent.futures
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from hashlib import sha1 as sha
 import os
 import sys
 from hashlib import md5
 import io
+import json
+import queue
 from threading import Thread
 import threading
+import zlib
 import configparser
 import logging
 from logging.handlers import RotatingFileHandler
@@ -18,6 +31,10 @@ try:
     from oss.oss_xml_handler import *
 except:
     from oss_xml_handler import *
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 #LOG_LEVEL can be one of DEBUG INFO ERROR CRITICAL WARNNING
 DEBUG = False 
@@ -34,7 +51,7 @@ class EmptyHandler(logging.Handler):
     pass
 
 def helper_get_host_from_resp(res, bucket):
-    host = helper_get_host_from_headers(res.getheaders(), bucket)
+    host = helper_get_host_from_headers(get_header_map(res), bucket)
     if not host:
         xml = res.read()
         host = RedirectXml(xml).Endpoint().strip()
@@ -42,8 +59,10 @@ def helper_get_host_from_resp(res, bucket):
     return host
 
 def helper_get_host_from_headers(headers, bucket):
-    mp = convert_header2map(headers)
-    location = safe_get_element('location', mp).strip()
+    mp = headers
+    if not isinstance(mp, HeaderMap):
+        mp = convert_header2map(headers)
+    location = mp.get('location', '').strip()
     #https://bucket.oss.aliyuncs.com or http://oss.aliyuncs.com/bucket
     location = location.replace("https://", "").replace("http://", "")
     if location.startswith("%s." % bucket):
@@ -65,6 +84,62 @@ def helper_get_host_from_endpoint(host, bucket):
         host = host[len(bucket)+1:]
     return host
 
+def helper_get_host_from_location(location, host):
+    '''
+    build the endpoint of a bucket location from the default host, eg:
+    oss-cn-qingdao + oss-cn-hangzhou.aliyuncs.com -> oss-cn-qingdao.aliyuncs.com
+    '''
+    location = location.strip()
+    if not location or is_ip(host):
+        return ""
+    host_port_list = host.split(':')
+    domain_list = host_port_list[0].split('.', 1)
+    if len(domain_list) != 2:
+        return ""
+    if domain_list[0].endswith("-internal") and not location.endswith("-internal"):
+        location += "-internal"
+    new_host = "%s.%s" % (location, domain_list[1])
+    if len(host_port_list) == 2:
+        new_host = "%s:%s" % (new_host, host_port_list[1])
+    return new_host
+
+class EndpointCache:
+    '''
+    Endpoint of each bucket, learned from redirects or from the bucket location.
+    Entries expire after ttl seconds, the oldest ones are dropped beyond max_size.
+    '''
+    def __init__(self, ttl=3600, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.endpoint_map = {}
+        self.lock = threading.Lock()
+
+    def get(self, bucket):
+        with self.lock:
+            item = self.endpoint_map.get(bucket)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                del self.endpoint_map[bucket]
+                return None
+            return item[0]
+
+    def set(self, bucket, host, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.endpoint_map.pop(bucket, None)
+            while len(self.endpoint_map) >= self.max_size:
+                del self.endpoint_map[next(iter(self.endpoint_map))]
+            self.endpoint_map[bucket] = (host, time.time() + ttl)
+
+    def invalidate(self, bucket=None):
+        with self.lock:
+            if bucket is None:
+                self.endpoint_map = {}
+            else:
+                self.endpoint_map.pop(bucket, None)
+
 def check_bucket_valid(bucket):
     alphabeta = "abcdefghijklmnopqrstuvwxyz0123456789-"
     if len(bucket) < 3 or len(bucket) > 63:
@@ -79,81 +154,171 @@ def check_bucket_valid(bucket):
     return True
 
 ########## function for Authorization ##########
-def _format_header(headers=None):
+class OssSigner:
     '''
-    format the headers that self define
-    convert the self define headers to lower.
+    Sign requests with one secret key.
+    The HMAC state keyed by the secret key is computed once and copied for each request.
     '''
-    if not headers:
-        headers = {}
-    tmp_headers = {}
-    for k in headers.keys():
-        if k.lower().startswith(SELF_DEFINE_HEADER_PREFIX):
-            k_lower = k.lower()
-            tmp_headers[k_lower] = headers[k]
-        else:
-            tmp_headers[k] = headers[k]
-    return tmp_headers
+    def __init__(self, secret_access_key, debug=DEBUG):
+        self.secret_access_key = secret_access_key
+        self.debug = debug
+        self.hmac = hmac.new(secret_access_key.encode(), digestmod=sha)
+
+    def get_string_to_sign(self, method, headers=None, resource="/"):
+        content_md5 = ""
+        content_type = ""
+        date = ""
+        oss_headers = {}
+        if headers:
+            if isinstance(headers, HeaderMap):
+                header_items = headers.lower_items()
+            else:
+                header_items = [(k.lower(), v) for (k, v) in headers.items()]
+            for k_lower, v in header_items:
+                if k_lower.startswith(SELF_DEFINE_HEADER_PREFIX):
+                    oss_headers[k_lower] = v
+                elif k_lower == 'content-md5':
+                    content_md5 = v
+                elif k_lower == 'content-type':
+                    content_type = v
+                elif k_lower == 'date':
+                    date = v
+        canonicalized_oss_headers = ""
+        if oss_headers:
+            canonicalized_oss_headers = "".join(["%s:%s\n" % (k, oss_headers[k]) for k in sorted(oss_headers)])
+        return "%s\n%s\n%s\n%s\n%s%s" % (method, content_md5.strip(), content_type, date, canonicalized_oss_headers, resource)
+
+    def sign_string(self, string_to_sign):
+        h = self.hmac.copy()
+        h.update(string_to_sign.encode())
+        return base64.b64encode(h.digest()).decode()
+
+    def sign(self, method, headers=None, resource="/", result=None):
+        '''
+        Create the authorization for OSS based on header input.
+        You should put it into "Authorization" parameter of header.
+        '''
+        string_to_sign = self.get_string_to_sign(method, headers, resource)
+        if result is not None:
+            result.append(string_to_sign)
+        sign_result = self.sign_string(string_to_sign)
+        if self.debug:
+            logger = getlogger(self.debug)
+            logger.debug("string_to_sign:%s\n \nlength of string_to_sign:%d\n" % (string_to_sign, len(string_to_sign)))
+            logger.debug("sign result:%s" % sign_result)
+        return sign_result
+
+def create_sign_url_list(secret_access_key, string_to_sign_prefix, sub_resource, url_prefix, url_suffix, object_list):
+    '''
+    sign the url of each object in object_list, the object name is the only
+    part that differs from one url to another.
+    string_to_sign_prefix ends with the "/bucket/" part of the resource.
+    '''
+    base_hmac = OssSigner(secret_access_key).hmac
+    quote = urllib.parse.quote
+    b64encode = base64.b64encode
+    url_list = []
+    for object in object_list:
+        h = base_hmac.copy()
+        h.update((string_to_sign_prefix + object + sub_resource).encode())
+        url_list.append(url_prefix + object + url_suffix + quote(b64encode(h.digest()).decode()))
+    return url_list
+
+def get_sign_url_cache_key(*args):
+    '''
+    build a hashable key from the arguments of a sign url call, dicts are
+    turned into sorted tuples.
+    '''
+    key = []
+    for arg in args:
+        if isinstance(arg, dict):
+            arg = tuple(sorted((str(k), str(v)) for (k, v) in arg.items()))
+        key.append(arg)
+    return tuple(key)
+
+class SignUrlCache:
+    '''
+    Bounded LRU of signature urls.
+    An url is reused while it stays valid for more than min_valid_time seconds.
+
+    :type max_size: int
+    :param: max number of urls kept
+
+    :type min_valid_time: int
+    :param: seconds an url must still be valid to be returned
+    '''
+    def __init__(self, max_size=10000, min_valid_time=30):
+        self.max_size = max_size
+        self.min_valid_time = min_valid_time
+        self.url_map = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self.lock:
+            item = self.url_map.get(key)
+            if item is not None:
+                if item[1] - time.time() > self.min_valid_time:
+                    self.url_map.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return item[0]
+                del self.url_map[key]
+                self.stats['evictions'] += 1
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key, url, expire_time):
+        with self.lock:
+            self.url_map[key] = (url, expire_time)
+            self.url_map.move_to_end(key)
+            while len(self.url_map) > self.max_size:
+                self.url_map.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.url_map.clear()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.url_map)
+            return stats
 
 def get_assign(secret_access_key, method, headers=None, resource="/", result=None, debug=DEBUG):
     '''
     Create the authorization for OSS based on header input.
     You should put it into "Authorization" parameter of header.
     '''
-    if not headers:
-        headers = {}
-    if not result:
-        result = []
-    content_md5 = ""
-    content_type = ""
-    date = ""
-    canonicalized_oss_headers = ""
-    logger = getlogger(debug)
-    logger.debug("secret_access_key: %s" % secret_access_key)
-    content_md5 = safe_get_element('Content-MD5', headers)
-    content_type = safe_get_element('Content-Type', headers)
-    date = safe_get_element('Date', headers)
-    canonicalized_resource = resource
-    tmp_headers = _format_header(headers)
-    if len(tmp_headers) > 0:
-        x_header_list = sorted(tmp_headers.keys())
-        for k in x_header_list:
-            if k.startswith(SELF_DEFINE_HEADER_PREFIX):
-                canonicalized_oss_headers += "%s:%s\n" % (k, tmp_headers[k]) 
-    string_to_sign = method + "\n" + content_md5.strip() + "\n" + content_type + "\n" + date + "\n" + canonicalized_oss_headers + canonicalized_resource
-    result.append(string_to_sign)
-    logger.debug("method:%s\n content_md5:%s\n content_type:%s\n data:%s\n canonicalized_oss_headers:%s\n canonicalized_resource:%s\n" % (method, content_md5, content_type, date, canonicalized_oss_headers, canonicalized_resource))
-    logger.debug("string_to_sign:%s\n \nlength of string_to_sign:%d\n" % (string_to_sign, len(string_to_sign)))
-    h = hmac.new(secret_access_key.encode(), string_to_sign.encode(), sha)
-    sign_result = base64.b64encode(h.digest()).decode().strip()
-    logger.debug("sign result:%s" % sign_result)
-    return sign_result
+    return OssSigner(secret_access_key, debug).sign(method, headers, resource, result)
+
+SUB_RESOURCE_LIST = sorted(['response-content-type', 'response-content-language', \
+                            'response-cache-control', 'logging', 'response-content-encoding', \
+                            'acl', 'uploadId', 'uploads', 'partNumber', 'group', \
+                            'delete', 'website', 'location', 'objectInfo', \
+                            'response-expires', 'response-content-disposition'])
+#lower name -> (position in the sorted list, name)
+SUB_RESOURCE_MAP = dict((k.lower(), (i, k)) for (i, k) in enumerate(SUB_RESOURCE_LIST))
 
 def get_resource(params=None):
     if not params:
         return ""
-    tmp_headers = {}
+    sub_resource_map = {}
     for k, v in params.items():
-        tmp_k = k.lower().strip()
-        tmp_headers[tmp_k] = v
-    override_response_list = ['response-content-type', 'response-content-language', \
-                              'response-cache-control', 'logging', 'response-content-encoding', \
-                              'acl', 'uploadId', 'uploads', 'partNumber', 'group', \
-                              'delete', 'website', 'location', 'objectInfo', \
-                              'response-expires', 'response-content-disposition']
-    override_response_list.sort()
-    resource = ""
-    separator = "?"
-    for i in override_response_list:
-        if i.lower() in tmp_headers:
-            resource += separator
-            resource += i
-            tmp_key = str(tmp_headers[i.lower()])
-            if len(tmp_key) != 0:
-                resource += "="
-                resource += tmp_key 
-            separator = '&'
-    return resource
+        item = SUB_RESOURCE_MAP.get(k.lower().strip())
+        if item is not None:
+            sub_resource_map[item[0]] = (item[1], v)
+    if not sub_resource_map:
+        return ""
+    resource_list = []
+    for i in sorted(sub_resource_map):
+        (k, v) = sub_resource_map[i]
+        v = str(v)
+        if len(v) != 0:
+            resource_list.append("%s=%s" % (k, v))
+        else:
+            resource_list.append(k)
+    return "?" + "&".join(resource_list)
 
 def append_param(url, params):
     '''
@@ -268,7 +433,7 @@ def clear_all_objects_in_bucket(oss_instance, bucket, delete_marker="", delete_u
     delete_all_objects(oss_instance, bucket, prefix, delimiter, delete_marker, maxkeys, debug)
     delete_all_parts(oss_instance, bucket, delete_marker, delete_upload_id_marker, debug)
     res = oss_instance.delete_bucket(bucket)
-    if (res.status / 100 != 2 and res.status != 404):
+    if (res.status // 100 != 2 and res.status != 404):
         print("clear_all_objects_in_bucket: delete bucket:%s fail, ret:%s, request id:%s" % (bucket, res.status, res.getheader("x-oss-request-id")))
         return False
     return True
@@ -289,7 +454,7 @@ def delete_all_objects(oss_instance, bucket, prefix="", delimiter="", delete_mar
         if object_list:
             object_list_xml = create_delete_object_msg_xml(object_list)
             res = oss_instance.batch_delete_object(bucket, object_list_xml)
-            if res.status/100 != 2:
+            if res.status // 100 != 2:
                 if marker:
                     print("delete_all_objects: batch delete objects in bucket:%s fail, ret:%s, request id:%s, first object:%s, marker:%s" % (bucket, res.status, res.getheader("x-oss-request-id"), object_list[0], marker))
                 else:
@@ -318,7 +483,7 @@ def delete_all_parts(oss_instance, bucket, delete_object_marker="", delete_uploa
         for i in fl:
             object = i[0]
             res = oss_instance.cancel_upload(bucket, object, i[1])
-            if (res.status / 100 != 2 and res.status != 404):
+            if (res.status // 100 != 2 and res.status != 404):
                 print("delete_all_parts: cancel upload object:%s, upload_id:%s FAIL, ret:%s, request-id:%s" % (object, i[1], res.status, res.getheader("x-oss-request-id")))
             else:
                 delete_mulitipart_num += 1
@@ -337,7 +502,7 @@ def clean_all_bucket(oss_instance):
     it will clean all bucket, including the all objects in bucket.
     '''
     res = oss_instance.get_service()
-    if (res.status / 100) == 2:
+    if (res.status // 100) == 2:
         h = GetServiceXml(res.read())
         for b in h.bucket_list:
             if not clear_all_objects_in_bucket(oss_instance, b.name):
@@ -370,14 +535,14 @@ def pgfs_clear_all_objects_in_bucket(oss_instance, bucket):
     b.get_all_object_in_bucket(oss_instance, bucket)
     for i in b.object_list:
         res = oss_instance.delete_object(bucket, i)
-        if (res.status / 100 != 2):
+        if (res.status // 100 != 2):
             print("clear_all_objects_in_bucket: delete object fail, ret is:", res.status, "bucket is:", bucket, "object is: ", i)
             return False
         else:
             pass
 
     res = oss_instance.delete_bucket(bucket)
-    if (res.status / 100 != 2 and res.status != 404):
+    if (res.status // 100 != 2 and res.status != 404):
         print("clear_all_objects_in_bucket: delete bucket fail, ret is: %s, request id is:%s" % (res.status, res.getheader("x-oss-request-id")))
         return False
     return True
@@ -387,7 +552,7 @@ def pgfs_clean_all_bucket(oss_instance):
     it will clean all bucket, including the all objects in bucket.
     '''
     res = oss_instance.get_service()
-    if (res.status / 100) == 2:
+    if (res.status // 100) == 2:
         h = GetServiceXml(res.read())
         for b in h.bucket_list:
             print(b)
@@ -602,6 +767,1220 @@ def get_part_map(oss, bucket, object, upload_id):
         part_map[str(part[0])] = part[1]
     return part_map
 
+def get_upload_part_size(part_list, default=None):
+    '''
+    The part size of an upload from its uploaded parts as listed by
+    get_part_list: the size of part 1, or of any part but the last one.
+
+    Returns:
+        the part size, default (DEFAULT_PART_SIZE) if the parts do not tell
+    '''
+    if default is None:
+        default = DEFAULT_PART_SIZE
+    size_map = dict((int(part[0]), int(part[2])) for part in part_list)
+    if 1 in size_map:
+        return size_map[1]
+    if size_map:
+        last_part_number = max(size_map.keys())
+        size_list = [size for part_number, size in size_map.items() if part_number != last_part_number]
+        if size_list:
+            return max(size_list)
+    return default
+
+########## retry ##########
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+class RetryPolicy:
+    '''
+    Retry with exponential backoff and full jitter.
+    Connection errors, 5xx (except 501) and 429 are retried, anything else is not.
+    A request that is not idempotent (POST) may already have been applied
+    when it failed: it is only retried on an error raised before it could
+    be sent, or on 429 and 503 which tell it was refused, see
+    is_retryable_request_error and is_retryable_request_status.
+
+    :type max_retries: int
+    :param: retries after the first attempt
+
+    :type base_delay: float
+    :param: seconds before the first retry, doubled for each retry
+
+    :type max_delay: float
+    :param: upper bound of one backoff
+
+    :type deadline: float
+    :param: seconds one operation may take including its retries, None is no limit
+
+    :type jitter: bool
+    :param: sleep a random time in [0, backoff] instead of the full backoff
+    '''
+    def __init__(self, max_retries=5, base_delay=0.2, max_delay=20, deadline=None, jitter=True):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.stats = {'operations': 0, 'attempts': 0, 'retries': 0, 'failures': 0, 'sleep_time': 0.0}
+
+    def is_retryable_status(self, status):
+        return status == 429 or (500 <= status < 600 and status != 501)
+
+    def is_retryable_error(self, error):
+        return isinstance(error, (ConnectionError, socket.timeout, TimeoutError, EOFError, http.client.HTTPException))
+
+    def is_retryable_request_error(self, method, error):
+        '''
+        Whether a request of method that failed with error may be sent again.
+        A POST may already have been applied unless the connection was refused.
+        '''
+        if method.upper() in IDEMPOTENT_METHODS:
+            return self.is_retryable_error(error)
+        return isinstance(error, ConnectionRefusedError)
+
+    def is_retryable_request_status(self, method, status):
+        '''
+        Whether a request of method answered with status may be sent again.
+        A POST may have been applied unless the server refused it.
+        '''
+        if method.upper() in IDEMPOTENT_METHODS:
+            return self.is_retryable_status(status)
+        return status in (429, 503)
+
+    def get_delay(self, retry_num):
+        delay = min(self.max_delay, self.base_delay * (2 ** retry_num))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def start(self, max_retries=None, deadline=None):
+        '''
+        Start one operation, returns the RetryState used to drive its attempts.
+        '''
+        if max_retries is None:
+            max_retries = self.max_retries
+        if deadline is None:
+            deadline = self.deadline
+        self.record(operations=1, attempts=1)
+        return RetryState(self, max_retries, deadline)
+
+    def record(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.stats[k] += v
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def reset_stats(self):
+        with self.lock:
+            for k in self.stats.keys():
+                self.stats[k] = 0
+
+class RetryState:
+    '''
+    Attempts of one operation under a RetryPolicy, eg:
+
+    retry = policy.start()
+    while True:
+        try:
+            res = do_request()
+        except Exception as e:
+            if retry.should_retry(error=e):
+                retry.sleep()
+                continue
+            raise
+        if retry.should_retry(status=res.status):
+            res.read()
+            retry.sleep()
+            continue
+        return res
+    '''
+    def __init__(self, policy, max_retries, deadline):
+        self.policy = policy
+        self.max_retries = max_retries
+        self.retry_num = 0
+        self.start_time = time.time()
+        self.deadline_time = None
+        if deadline is not None:
+            self.deadline_time = self.start_time + deadline
+        self.delay = 0
+        self.is_failed = False
+
+    def should_retry(self, error=None, status=None):
+        '''
+        Whether the failed attempt, given by error or by status, may be retried.
+        '''
+        if error is not None:
+            retryable = self.policy.is_retryable_error(error)
+        elif status is not None:
+            retryable = self.policy.is_retryable_status(status)
+        else:
+            retryable = True
+        if not retryable:
+            return False
+        if self.retry_num >= self.max_retries:
+            self.fail()
+            return False
+        self.delay = self.policy.get_delay(self.retry_num)
+        if self.deadline_time is not None and time.time() + self.delay >= self.deadline_time:
+            self.fail()
+            return False
+        return True
+
+    def fail(self):
+        #the state may be shared by nested loops, count the operation once
+        if not self.is_failed:
+            self.is_failed = True
+            self.policy.record(failures=1)
+
+    def next_delay(self):
+        '''
+        Count the retry and return the seconds to wait before it.
+        '''
+        delay = self.delay
+        self.retry_num += 1
+        self.delay = 0
+        self.policy.record(attempts=1, retries=1, sleep_time=delay)
+        return delay
+
+    def sleep(self):
+        delay = self.next_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+########## connection pool ##########
+class PooledHTTPResponse(http.client.HTTPResponse):
+    '''
+    HTTPResponse that gives its connection back to the pool once the body
+    has been read to the end.
+    '''
+    _oss_release = None
+    _header_map = None
+
+    @property
+    def header_map(self):
+        '''
+        HeaderMap of the response headers, built on first use.
+        '''
+        if self._header_map is None:
+            self._header_map = HeaderMap(self.getheaders())
+        return self._header_map
+
+    def _close_conn(self):
+        http.client.HTTPResponse._close_conn(self)
+        release = self._oss_release
+        self._oss_release = None
+        if release:
+            release(True)
+
+    def close(self):
+        release = None
+        if self.fp is not None and (self.chunked or self.length != 0):
+            #unread body bytes are still on the socket, it can not be reused
+            release = self._oss_release
+            self._oss_release = None
+        try:
+            http.client.HTTPResponse.close(self)
+        finally:
+            if release:
+                release(False)
+
+class _PooledConnectionMixin:
+    response_class = PooledHTTPResponse
+    pool = None
+    reused = False
+
+    def getresponse(self):
+        res = super().getresponse()
+        if self.pool is not None:
+            res._oss_release = self._release_to_pool
+            if res.length == 0 and not res.chunked:
+                #nothing to read (HEAD, 204, 304 ...), release it right now
+                res.read()
+        return res
+
+    def _release_to_pool(self, reusable):
+        if reusable and self.sock is not None:
+            self.pool.put(self)
+        else:
+            self.close()
+
+class PooledHTTPConnection(_PooledConnectionMixin, http.client.HTTPConnection):
+    pass
+
+class PooledHTTPSConnection(_PooledConnectionMixin, http.client.HTTPSConnection):
+    pass
+
+def is_connection_dropped(conn):
+    '''
+    An idle keep-alive socket should never be readable, if it is the server
+    closed it (or sent garbage) while it was in the pool.
+    '''
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        #select.select can not watch a fd beyond FD_SETSIZE
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(0))
+        readable, writable, errored = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+class ConnectionPool:
+    '''
+    Per-host pool of keep-alive connections.
+
+    :type max_idle: int
+    :param: idle connections kept for one (host, port, scheme)
+
+    :type max_size: int
+    :param: idle connections kept for all hosts
+
+    :type idle_timeout: int
+    :param: seconds an idle connection may stay in the pool
+    '''
+    def __init__(self, max_idle=10, max_size=100, idle_timeout=60):
+        self.max_idle = max_idle
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.idle_num = 0
+        self.lock = threading.Lock()
+
+    def get(self, host, port, is_security=False, timeout=10):
+        key = (host, port, is_security)
+        now = time.time()
+        while True:
+            conn = None
+            with self.lock:
+                conn_list = self.idle.get(key)
+                if conn_list:
+                    (conn, last_used) = conn_list.pop()
+                    self.idle_num -= 1
+            if conn is None:
+                break
+            if now - last_used > self.idle_timeout or is_connection_dropped(conn):
+                conn.close()
+                continue
+            conn.reused = True
+            return conn
+        if is_security:
+            conn = PooledHTTPSConnection(host=host, port=port, timeout=timeout)
+        else:
+            conn = PooledHTTPConnection(host=host, port=port, timeout=timeout)
+        conn.pool = self
+        conn.pool_key = key
+        return conn
+
+    def put(self, conn):
+        evicted = []
+        with self.lock:
+            conn_list = self.idle.setdefault(conn.pool_key, [])
+            if len(conn_list) >= self.max_idle:
+                evicted.append(conn_list.pop(0)[0])
+                self.idle_num -= 1
+            conn_list.append((conn, time.time()))
+            self.idle_num += 1
+            if self.idle_num > self.max_size:
+                evicted.extend(self._evict_oldest(self.idle_num - self.max_size))
+        for item in evicted:
+            item.close()
+
+    def _evict_oldest(self, num):
+        evicted = []
+        for i in range(num):
+            oldest_key = None
+            for key, conn_list in self.idle.items():
+                if conn_list and (oldest_key is None or conn_list[0][1] < self.idle[oldest_key][0][1]):
+                    oldest_key = key
+            if oldest_key is None:
+                break
+            evicted.append(self.idle[oldest_key].pop(0)[0])
+            self.idle_num -= 1
+        return evicted
+
+    def clear(self):
+        with self.lock:
+            conn_list = [item[0] for items in self.idle.values() for item in items]
+            self.idle = {}
+            self.idle_num = 0
+        for conn in conn_list:
+            conn.close()
+
+class BufferPool:
+    '''
+    Free list of bytearrays reused by downloads instead of allocating a new
+    buffer for each read. At most max_free buffers are kept.
+    '''
+    def __init__(self, max_free=4):
+        self.max_free = max_free
+        self.free_list = []
+        self.lock = threading.Lock()
+
+    def get(self, size):
+        '''
+        Returns:
+            a bytearray of at least size bytes
+        '''
+        with self.lock:
+            while self.free_list:
+                buf = self.free_list.pop()
+                if len(buf) >= size:
+                    return buf
+        return bytearray(size)
+
+    def put(self, buf):
+        with self.lock:
+            if len(self.free_list) < self.max_free:
+                self.free_list.append(buf)
+
+    def clear(self):
+        with self.lock:
+            self.free_list = []
+
+########## checkpoint ##########
+def write_journal_header(path, header):
+    '''
+    Start the journal at path with header, replacing any older journal. The
+    header is written to a temporary file that is renamed into place.
+    '''
+    journal_dir = os.path.dirname(path)
+    if journal_dir and not os.path.isdir(journal_dir):
+        os.makedirs(journal_dir)
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        fp.write(json.dumps(header) + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+def append_journal_record(path, record):
+    with open(path, 'a') as fp:
+        fp.write("\n" + json.dumps(record))
+        fp.flush()
+        os.fsync(fp.fileno())
+
+def sync_file_data(fd):
+    '''
+    Make the data written to the file descriptor fd durable, before it is
+    recorded as done in a journal.
+    '''
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+def read_journal(path):
+    '''
+    Returns:
+        (header, record_list) of the journal at path, (None, []) if there is
+        none. A torn record is skipped.
+    '''
+    try:
+        fp = open(path, 'r')
+    except (IOError, OSError):
+        return (None, [])
+    with fp:
+        lines = fp.read().split("\n")
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        return (None, [])
+    record_list = []
+    for line in lines[1:]:
+        try:
+            record_list.append(json.loads(line))
+        except ValueError:
+            continue
+    return (header, record_list)
+
+class UploadCheckpoint:
+    '''
+    On-disk journal of one multipart upload, so that a restarted process can
+    resume it without listing the uploaded parts or hashing the file again.
+    The file is named after (bucket, object, file path, size, mtime), so a
+    changed file never matches an old journal.
+
+    The first line holds the upload_id and the part plan, it is written to a
+    temporary file and renamed into place. Every finished part appends one
+    line with its md5; a torn last line is ignored when loading.
+    '''
+    def __init__(self, checkpoint_dir, bucket, object, file_path):
+        self.checkpoint_dir = checkpoint_dir
+        self.bucket = bucket
+        self.object = object
+        self.file_path = os.path.abspath(file_path)
+        st = os.stat(self.file_path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        key = "\n".join([bucket, object, self.file_path, str(self.size), str(self.mtime)])
+        self.path = os.path.join(checkpoint_dir, sum_string(key) + ".upload")
+        self.upload_id = ""
+        self.part_size = 0
+        self.part_msg_list = []
+        self.part_md5_map = {}
+        self.lock = threading.Lock()
+
+    def get_header(self):
+        return {"bucket": self.bucket, "object": self.object, "file_path": self.file_path,
+                "size": self.size, "mtime": self.mtime}
+
+    def load(self):
+        '''
+        Returns:
+            True if a journal of this upload was found
+        '''
+        (header, record_list) = read_journal(self.path)
+        if header is None:
+            return False
+        for k, v in self.get_header().items():
+            if header.get(k) != v:
+                return False
+        self.upload_id = header["upload_id"]
+        self.part_size = header["part_size"]
+        self.part_msg_list = [(part[0], part[1], "", part[2], part[3]) for part in header["parts"]]
+        self.part_md5_map = {}
+        for record in record_list:
+            self.part_md5_map[record["part"]] = record["md5"]
+        return True
+
+    def start(self, upload_id, part_size, part_msg_list):
+        '''
+        Write a new journal for upload_id, replacing any older one.
+        '''
+        header = self.get_header()
+        header["upload_id"] = upload_id
+        header["part_size"] = part_size
+        header["parts"] = [(part[0], part[1], part[3], part[4]) for part in part_msg_list]
+        with self.lock:
+            write_journal_header(self.path, header)
+            self.upload_id = upload_id
+            self.part_size = part_size
+            self.part_msg_list = list(part_msg_list)
+            self.part_md5_map = {}
+
+    def add_part(self, part_order, md5):
+        with self.lock:
+            append_journal_record(self.path, {"part": part_order, "md5": md5})
+            self.part_md5_map[part_order] = md5
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class DownloadCheckpoint:
+    '''
+    On-disk journal of the byte ranges of an object already written to a
+    partial file, so an interrupted download only fetches what is missing.
+    The journal is named after (bucket, object, file path) and is only used
+    while the ETag, Last-Modified and size of the object are those it was
+    started for. A range is recorded after it is written to the file and
+    synced to disk, so after a crash the journal never claims data the
+    file does not hold.
+    '''
+    def __init__(self, checkpoint_dir, bucket, object, file_path):
+        self.checkpoint_dir = checkpoint_dir
+        self.bucket = bucket
+        self.object = object
+        self.file_path = os.path.abspath(file_path)
+        key = "\n".join([bucket, object, self.file_path])
+        self.path = os.path.join(checkpoint_dir, sum_string(key) + ".download")
+        self.part_size = 0
+        self.done_range_set = set()
+        self.lock = threading.Lock()
+
+    def get_header(self, etag, last_modified, size):
+        return {"bucket": self.bucket, "object": self.object, "file_path": self.file_path,
+                "etag": etag, "last_modified": last_modified, "size": size}
+
+    def load(self, etag, last_modified, size):
+        '''
+        Returns:
+            True if a journal of this version of the object was found and the
+            partial file is still there
+        '''
+        (header, record_list) = read_journal(self.path)
+        if header is None:
+            return False
+        for k, v in self.get_header(etag, last_modified, size).items():
+            if header.get(k) != v:
+                return False
+        if not os.path.isfile(self.file_path) or os.path.getsize(self.file_path) != size:
+            return False
+        self.part_size = header["part_size"]
+        self.done_range_set = set()
+        for record in record_list:
+            self.done_range_set.add((record["start"], record["end"]))
+        return True
+
+    def start(self, etag, last_modified, size, part_size):
+        header = self.get_header(etag, last_modified, size)
+        header["part_size"] = part_size
+        with self.lock:
+            write_journal_header(self.path, header)
+            self.part_size = part_size
+            self.done_range_set = set()
+
+    def add_range(self, start, end):
+        with self.lock:
+            append_journal_record(self.path, {"start": start, "end": end})
+            self.done_range_set.add((start, end))
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+########## hash index ##########
+class HashIndex:
+    '''
+    Persistent sqlite index of the md5 of local files, so unchanged files are
+    not hashed again. An entry is keyed by path and part size (0 for the
+    whole file) and is only used while the size, mtime and inode of the
+    file are those it was computed for. When more than max_entries entries
+    are stored the least recently used ones are evicted.
+    The part md5 are only found again for the same part size, i.e. for an
+    upload that cuts the file at the same boundaries.
+    Lookups do not write: the last use of the entries found and the out
+    of date entries to delete are kept in memory and written with the next
+    put, or every flush_num lookups, or on close. Every write is committed
+    at once, so processes sharing the db file never wait long for each
+    other. The index is only a cache: a failed write is logged, not raised.
+    One instance can be shared by many threads.
+    '''
+    def __init__(self, db_path, max_entries=100000, flush_num=1000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.flush_num = flush_num
+        self.used_map = {}
+        self.stale_path_set = set()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hash_index ("
+                          "path TEXT, part_size INTEGER, size INTEGER, mtime INTEGER, inode INTEGER, "
+                          "md5 TEXT, last_used REAL, PRIMARY KEY (path, part_size))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS hash_index_last_used ON hash_index (last_used)")
+        self.conn.commit()
+
+    def get_stat(self, file_path):
+        st = os.stat(file_path)
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def get(self, file_path, part_size=0):
+        '''
+        Returns:
+            the stored md5 of the whole file (part_size 0) or the list of the
+            md5 of its parts of part_size, None if unknown or out of date
+        '''
+        file_path = os.path.abspath(file_path)
+        try:
+            file_stat = self.get_stat(file_path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime, inode, md5 FROM hash_index WHERE path=? AND part_size=?",
+                                    (file_path, part_size)).fetchone()
+            if row is None:
+                return None
+            if tuple(row[:3]) != file_stat:
+                self.stale_path_set.add(file_path)
+                return None
+            self.used_map[(file_path, part_size)] = time.time()
+            if len(self.used_map) + len(self.stale_path_set) >= self.flush_num:
+                self._commit(self._flush)
+        if part_size:
+            return json.loads(row[3])
+        return row[3]
+
+    def _flush(self):
+        '''
+        NOT public API
+        Write the last use of the entries found and delete the out of date
+        ones seen since the last flush, the caller holds the lock and commits.
+        '''
+        used_map = self.used_map
+        stale_path_set = self.stale_path_set
+        self.used_map = {}
+        self.stale_path_set = set()
+        if stale_path_set:
+            self.conn.executemany("DELETE FROM hash_index WHERE path=?", [(path,) for path in stale_path_set])
+        if used_map:
+            self.conn.executemany("UPDATE hash_index SET last_used=? WHERE path=? AND part_size=?",
+                                  [(last_used, path, part_size) for (path, part_size), last_used in used_map.items()])
+
+    def _commit(self, write):
+        '''
+        NOT public API
+        Run write() and commit it, the caller holds the lock. A failure,
+        e.g. the database locked by another process for too long, is rolled
+        back and logged.
+
+        Returns:
+            True if it was committed
+        '''
+        try:
+            write()
+            self.conn.commit()
+            return True
+        except sqlite3.Error as e:
+            try:
+                self.conn.rollback()
+            except sqlite3.Error:
+                pass
+            getlogger().warn("hash index %s not updated: %r" % (self.db_path, e))
+            return False
+
+    def put(self, file_path, md5, part_size=0, file_stat=None):
+        '''
+        Store md5 (a list of md5 if part_size is not 0). file_stat is the
+        (size, mtime, inode) from get_stat taken before hashing, so a file
+        changed meanwhile is never stored as up to date.
+
+        Returns:
+            True if it was stored
+        '''
+        file_path = os.path.abspath(file_path)
+        if file_stat is None:
+            file_stat = self.get_stat(file_path)
+        if part_size:
+            md5 = json.dumps(md5)
+        def write():
+            self._flush()
+            self.conn.execute("INSERT OR REPLACE INTO hash_index VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (file_path, part_size) + tuple(file_stat) + (md5, time.time()))
+            count = self.conn.execute("SELECT COUNT(*) FROM hash_index").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute("DELETE FROM hash_index WHERE rowid IN "
+                                  "(SELECT rowid FROM hash_index ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+        with self.lock:
+            return self._commit(write)
+
+    def invalidate(self, file_path):
+        with self.lock:
+            return self._commit(lambda: self.conn.execute("DELETE FROM hash_index WHERE path=?", (os.path.abspath(file_path),)))
+
+    def clear(self):
+        with self.lock:
+            self.used_map = {}
+            self.stale_path_set = set()
+            return self._commit(lambda: self.conn.execute("DELETE FROM hash_index"))
+
+    def close(self):
+        with self.lock:
+            self._commit(self._flush)
+            self.conn.close()
+
+########## compression ##########
+COMPRESSION_LIST = ["gzip", "zstd"]
+
+def get_compressor(compression, level=6):
+    '''
+    Returns a streaming compressor with compress() and flush() for the
+    Content-Encoding compression, "gzip" or "zstd" (needs zstandard).
+    '''
+    if compression == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == "zstd":
+        if zstandard is None:
+            raise Exception("-1, zstd compression needs the zstandard package.")
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise Exception("-1, unsupported compression %s, it should be one of %s." % (compression, COMPRESSION_LIST))
+
+def get_decompressor(content_encoding):
+    '''
+    Returns a zlib decompressor for a gzip content_encoding, None for any
+    other. zstd content is read by DecodingReader with a stream_reader.
+    '''
+    content_encoding = (content_encoding or "").strip().lower()
+    if content_encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return None
+
+class CompressedReader:
+    '''
+    Reads fp and returns its content compressed by compression, or as is if
+    compression is None, at most chunk_size bytes of fp are held at a time.
+    read() returns b"" at the end.
+    '''
+    def __init__(self, fp, compression, chunk_size=1024*1024, level=6):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.compressor = None
+        if compression:
+            self.compressor = get_compressor(compression, level)
+        self.is_eof = False
+        self.total_in = 0
+        self.total_out = 0
+
+    def read(self):
+        while not self.is_eof:
+            data = self.fp.read(self.chunk_size)
+            if data:
+                self.total_in += len(data)
+                if self.compressor is not None:
+                    data = self.compressor.compress(data)
+            else:
+                self.is_eof = True
+                if self.compressor is not None:
+                    data = self.compressor.flush()
+            if data:
+                self.total_out += len(data)
+                return data
+        return b""
+
+class DecodingReader:
+    '''
+    File-like reader of an object response that decodes its Content-Encoding
+    on the fly. Content that is not gzip or zstd encoded is returned as is.
+    At most chunk_size bytes are decoded at a time, however compressible the
+    content is.
+    '''
+    def __init__(self, res, chunk_size=1024*1024):
+        self.response = res
+        self.status = res.status
+        self.chunk_size = chunk_size
+        content_encoding = get_header_map(res).get("content-encoding", "").strip().lower()
+        self.stream = None
+        self.decompressor = None
+        if content_encoding == "zstd":
+            if zstandard is None:
+                raise Exception("-1, zstd decompression needs the zstandard package.")
+            self.stream = zstandard.ZstdDecompressor().stream_reader(res, read_size=chunk_size)
+        else:
+            self.decompressor = get_decompressor(content_encoding)
+        #encoded input not decoded yet
+        self.tail = b""
+        self.pending = b""
+        self.pos = 0
+        self.is_eof = False
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def getheaders(self):
+        return self.response.getheaders()
+
+    def _fill(self):
+        '''
+        Make sure some decoded data is pending unless the content is over.
+        '''
+        while self.pos >= len(self.pending) and not self.is_eof:
+            self.pos = 0
+            if self.stream is not None:
+                self.pending = self.stream.read(self.chunk_size)
+                if not self.pending:
+                    self.is_eof = True
+                continue
+            if not self.tail:
+                self.tail = self.response.read(self.chunk_size)
+                if not self.tail:
+                    self.is_eof = True
+                    self.pending = b""
+                    if self.decompressor is not None:
+                        self.pending = self.decompressor.flush()
+                    break
+            if self.decompressor is None:
+                self.pending = self.tail
+                self.tail = b""
+            else:
+                self.pending = self.decompressor.decompress(self.tail, self.chunk_size)
+                self.tail = self.decompressor.unconsumed_tail
+
+    def _take(self, amt):
+        data = self.pending[self.pos:self.pos + amt]
+        self.pos += len(data)
+        return data
+
+    def read(self, amt=-1):
+        if amt is None or amt < 0:
+            data_list = []
+            while True:
+                self._fill()
+                if self.pos >= len(self.pending):
+                    break
+                data_list.append(self._take(len(self.pending)))
+            return b"".join(data_list)
+        self._fill()
+        return self._take(amt)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def __iter__(self):
+        while True:
+            self._fill()
+            if self.pos >= len(self.pending):
+                return
+            yield self._take(len(self.pending))
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+########## sync ##########
+def iter_local_files(local_dir):
+    '''
+    Walk local_dir lazily and yield (relative_path, path, stat) of every
+    regular file. relative_path uses "/" and the files come in the byte
+    order of relative_path, the order of a bucket listing, so both can be
+    merged without holding either in memory.
+    '''
+    def walk(dir_path, relative_dir):
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            return
+        items = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    items.append((entry.name + "/", entry, True))
+                elif entry.is_file():
+                    items.append((entry.name, entry, False))
+            except OSError:
+                continue
+        items.sort(key=lambda item: item[0])
+        for name, entry, is_dir in items:
+            if is_dir:
+                yield from walk(entry.path, relative_dir + name)
+            else:
+                try:
+                    yield (relative_dir + name, entry.path, entry.stat())
+                except OSError:
+                    continue
+    return walk(local_dir, "")
+
+def iter_bucket_objects(oss, bucket, prefix="", maxkeys=1000):
+    '''
+    Yield (object, size, last_modify_time, etag) of the objects under prefix,
+    one listing page at a time.
+    '''
+    marker = ""
+    while True:
+        res = oss.get_bucket(bucket, prefix, marker, maxkeys=maxkeys)
+        body = res.read()
+        if res.status != 200:
+            raise Exception("%s, list bucket %s failed! %s" % (res.status, bucket, body))
+        (object_meta_list, marker) = get_object_list_marker_from_xml(body)
+        for (object, length, last_modify_time, etag) in object_meta_list:
+            yield (object, int(length), last_modify_time, etag)
+        if not marker:
+            break
+
+def parse_oss_time(time_string):
+    '''
+    Seconds since the epoch of a time like 2012-02-24T08:42:32.000Z, None if
+    it can not be parsed.
+    '''
+    try:
+        return calendar.timegm(time.strptime(time_string[:19], "%Y-%m-%dT%H:%M:%S"))
+    except (ValueError, TypeError):
+        return None
+
+def is_file_changed(file_path, file_stat, object_meta, hash_index=None):
+    '''
+    Whether the local file differs from the listed object. Sizes are compared
+    first, then the md5 with the ETag. The ETag of a multipart object is not
+    the md5 of its content, so for those the file only counts as changed
+    if it was modified after the object.
+    '''
+    (object, size, last_modify_time, etag) = object_meta
+    if size != file_stat.st_size:
+        return True
+    etag = etag.replace('"', "")
+    if len(etag) == 32 and "-" not in etag:
+        return md5sum(file_path, hash_index).upper() != etag.upper()
+    remote_time = parse_oss_time(last_modify_time)
+    if remote_time is None:
+        return True
+    return file_stat.st_mtime > remote_time
+
+class SyncProgress:
+    '''
+    Counters of a sync_directory run, updated by all its threads.
+    progress_callback, if given, is called with this object after each file.
+    '''
+    def __init__(self, progress_callback=None):
+        self.progress_callback = progress_callback
+        self.scanned_files = 0
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.skipped_files = 0
+        self.failed_list = []
+        self.start_time = time.time()
+        self.end_time = None
+        self.lock = threading.Lock()
+
+    def add_scanned(self):
+        with self.lock:
+            self.scanned_files += 1
+
+    def add_uploaded(self, size):
+        with self.lock:
+            self.uploaded_files += 1
+            self.uploaded_bytes += size
+        self.notify()
+
+    def add_skipped(self):
+        with self.lock:
+            self.skipped_files += 1
+        self.notify()
+
+    def add_failed(self, file_path, reason):
+        with self.lock:
+            self.failed_list.append((file_path, reason))
+        self.notify()
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def notify(self):
+        if self.progress_callback is not None:
+            self.progress_callback(self)
+
+    def get_elapsed_time(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def get_throughput(self):
+        '''
+        Uploaded bytes per second.
+        '''
+        elapsed_time = self.get_elapsed_time()
+        if elapsed_time <= 0:
+            return 0
+        return self.uploaded_bytes / elapsed_time
+
+    def __str__(self):
+        return "scanned:%d, uploaded:%d, skipped:%d, failed:%d, bytes:%d, seconds:%.1f, throughput:%.1f KB/s" % (
+            self.scanned_files, self.uploaded_files, self.skipped_files, len(self.failed_list),
+            self.uploaded_bytes, self.get_elapsed_time(), self.get_throughput() / 1024)
+
+########## object reader ##########
+def get_range_into(oss, bucket, object, start, view, headers=None, retry_times=None):
+    '''
+    Read the bytes of object from start into the writable buffer view with a
+    ranged GET, retried by the RetryPolicy of oss.
+
+    Returns:
+        the number of bytes read, less than len(view) only at the end of
+        the object
+    '''
+    view = memoryview(view).cast('B')
+    length = len(view)
+    if length == 0:
+        return 0
+    retry = oss.retry_policy.start(retry_times)
+    while True:
+        tmp_headers = HeaderMap(headers)
+        tmp_headers['Range'] = 'bytes=%d-%d' % (start, start + length - 1)
+        try:
+            res = oss.object_operation("GET", bucket, object, tmp_headers, retry_state=retry)
+            if res.status == 416:
+                res.read()
+                return 0
+            if res.status in (200, 206):
+                expected = int(get_header_map(res).get("content-length", "0"))
+                if res.status == 200:
+                    #the range was ignored and the whole object is sent, never
+                    #drain it: what is not needed is dropped with the connection
+                    if start >= expected:
+                        res.close()
+                        return 0
+                    skip = start
+                    while skip > 0:
+                        data = res.read(min(skip, 1024*1024))
+                        if not data:
+                            break
+                        skip -= len(data)
+                    expected -= start
+                expected = min(expected, length)
+                got = 0
+                while got < expected:
+                    n = res.readinto(view[got:expected])
+                    if not n:
+                        break
+                    got += n
+                if got >= expected:
+                    if res.status == 200:
+                        res.close()
+                    else:
+                        res.read()
+                    return got
+                error = http.client.IncompleteRead(b'', expected - got)
+                if not retry.should_retry(error=error):
+                    raise error
+            else:
+                body = res.read()
+                if not retry.should_retry(status=res.status):
+                    raise Exception("%s, get /%s/%s range %s failed! %s" % (res.status, bucket, object, tmp_headers['Range'], body))
+        except Exception as e:
+            if not retry.should_retry(error=e):
+                raise
+        retry.sleep()
+
+def coalesce_ranges(range_list, max_gap=64*1024, max_size=8*1024*1024):
+    '''
+    Merge the (offset, length) of range_list that are less than max_gap
+    bytes apart into requests of at most max_size bytes; a longer range is
+    kept alone. A range inside an earlier request always joins it.
+
+    Returns:
+        list of (start, end, [index in range_list...]), end excluded
+    '''
+    request_list = []
+    for index in sorted(range(len(range_list)), key=lambda i: range_list[i][0]):
+        (offset, length) = range_list[index]
+        end = offset + length
+        if request_list:
+            (last_start, last_end, index_list) = request_list[-1]
+            if end <= last_end or (offset <= last_end + max_gap and max(end, last_end) - last_start <= max_size):
+                request_list[-1] = (last_start, max(end, last_end), index_list + [index])
+                continue
+        request_list.append((offset, end, [index]))
+    return request_list
+
+class OssObjectReader(io.RawIOBase):
+    '''
+    Seekable read-only file of an object, read with ranged GETs of
+    block_size bytes. While it is read sequentially the next read_ahead
+    blocks are prefetched by thread_num threads. Block buffers are reused
+    once their block leaves the window. All ranges are fetched with If-Match
+    on the ETag found when opening, so the object can not change underneath.
+    Wrap it in io.BufferedReader for small reads.
+    '''
+    def __init__(self, oss, bucket, object, block_size=1024*1024, read_ahead=4, thread_num=2, headers=None):
+        io.RawIOBase.__init__(self)
+        self.oss = oss
+        self.bucket = bucket
+        self.object = object
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.headers = HeaderMap(headers)
+        res = oss.head_object(bucket, object, headers)
+        body = res.read()
+        if res.status != 200:
+            raise Exception("%s, head /%s/%s failed! %s" % (res.status, bucket, object, body))
+        header_map = get_header_map(res)
+        self.size = int(header_map.get("content-length", "0"))
+        self.etag = header_map.get("etag", "")
+        if self.etag:
+            self.headers['If-Match'] = self.etag
+        self.pos = 0
+        self.last_block = -1
+        self.block_map = {}
+        self.free_buffer_list = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(1, thread_num))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("invalid whence %s" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %s" % pos)
+        self.pos = pos
+        return self.pos
+
+    def _fetch_block(self, index, buf):
+        start = index * self.block_size
+        length = min(self.block_size, self.size - start)
+        return get_range_into(self.oss, self.bucket, self.object, start, memoryview(buf)[:length], self.headers)
+
+    def _submit_block(self, index):
+        if index in self.block_map or index * self.block_size >= self.size:
+            return
+        if self.free_buffer_list:
+            buf = self.free_buffer_list.pop()
+        else:
+            buf = bytearray(self.block_size)
+        self.block_map[index] = (buf, self.executor.submit(self._fetch_block, index, buf))
+
+    def _release_blocks(self, first, last):
+        '''
+        Drop the blocks out of [first, last], keeping their buffers for reuse.
+        '''
+        for index in list(self.block_map.keys()):
+            if first <= index <= last:
+                continue
+            (buf, future) = self.block_map.pop(index)
+            if future.done() or future.cancel():
+                self.free_buffer_list.append(buf)
+
+    def _get_block(self, index):
+        is_sequential = index in (self.last_block, self.last_block + 1)
+        last = index
+        if is_sequential:
+            last = index + self.read_ahead
+        self._release_blocks(index, last)
+        self._submit_block(index)
+        for i in range(index + 1, last + 1):
+            self._submit_block(i)
+        self.last_block = index
+        (buf, future) = self.block_map[index]
+        try:
+            length = future.result()
+        except:
+            self.block_map.pop(index, None)
+            raise
+        return memoryview(buf)[:length]
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        view = memoryview(b).cast('B')
+        total = 0
+        while total < len(view) and self.pos < self.size:
+            index = self.pos // self.block_size
+            block = self._get_block(index)
+            offset = self.pos - index * self.block_size
+            if len(block) <= offset:
+                #the object ended before the size of its HEAD, fetch the block again next time
+                self.block_map.pop(index, None)
+                raise http.client.IncompleteRead(bytes(view[:total]), self.size - self.pos)
+            n = min(len(block) - offset, len(view) - total)
+            view[total:total + n] = block[offset:offset + n]
+            total += n
+            self.pos += n
+        return total
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(wait=True)
+            self.block_map = {}
+            self.free_buffer_list = []
+        io.RawIOBase.close(self)
+
 ########## multi-thread ##########
 class DeleteObjectWorker(Thread):
     def __init__(self, oss, bucket, part_msg_list, retry_times=5):
@@ -627,232 +2006,526 @@ class DeleteObjectWorker(Thread):
             else:
                 break
             is_fail = True
-            retry_times = self.retry_times
-            while True:
-                try:
-                    if retry_times <= 0:
-                        break
-                    res = self.oss.delete_objects(bucket, object_list[begin:end])
-                    if res.status / 100 == 2:
-                        is_fail = False
-                        break
-                except:
-                    retry_times = retry_times - 1
-                    time.sleep(1)
+            try:
+                #delete_objects already retries by the retry policy of oss
+                res = self.oss.delete_objects(bucket, object_list[begin:end])
+                res.read()
+                is_fail = res.status // 100 != 2
+            except Exception as e:
+                print("delete object_list[%s:%s] error: %r" % (begin, end, e))
             if is_fail:
                 print("delete object_list[%s:%s] failed!, first is %s" % (begin, end, object_list[begin]))
             begin = end
             remain_length = remain_length - step
 
-class PutObjectGroupWorker(Thread):
-    def __init__(self, oss, bucket, file_path, part_msg_list, retry_times=5):
+class PartWorker(Thread):
+    '''
+    Base of the workers that upload parts. part_msg_list is either a list of
+    parts or a queue.Queue shared by all workers, in which case every worker
+    takes the next part as soon as it is free and stops at a None. The parts
+    that never succeeded are kept in failed_part_list as (part, reason).
+    '''
+    def __init__(self, part_msg_list, checkpoint=None):
         Thread.__init__(self)
+        self.part_msg_list = part_msg_list
+        self.failed_part_list = []
+        self.checkpoint = checkpoint
+
+    def iter_parts(self):
+        if not isinstance(self.part_msg_list, queue.Queue):
+            for part in self.part_msg_list:
+                yield part
+            return
+        while True:
+            part = self.part_msg_list.get()
+            if part is None:
+                return
+            yield part
+
+    def add_failed_part(self, part, reason):
+        self.failed_part_list.append((part, reason))
+
+    def get_part_md5(self, part):
+        '''
+        The md5 of a part, computed from the file if the planner left it empty.
+        '''
+        if part[2]:
+            return part[2]
+        return md5sum2(self.file_path, part[4], part[3])
+
+    def check_sent_part(self, part, res):
+        '''
+        Compare the md5 of the part with the returned ETag and remember it
+        in part_md5_map. The md5 computed while sending is used if any, else
+        the one of the planner or of the hash index, else it is read from
+        the file.
+        '''
+        content_md5 = getattr(res, "content_md5", "") or self.get_part_md5(part)
+        etag = get_header_map(res).get("etag", "").replace('"', "")
+        if etag and content_md5 and etag.upper() != content_md5.upper():
+            return False
+        self.add_done_part(part, content_md5)
+        return True
+
+    def add_done_part(self, part, md5):
+        self.part_md5_map[part[0]] = md5
+        if self.checkpoint is not None:
+            self.checkpoint.add_part(part[0], md5)
+
+def run_part_workers(create_worker, part_msg_list, thread_num=10):
+    '''
+    Put all parts into one queue and let at most thread_num workers made by
+    create_worker(part_queue) consume it.
+
+    Returns:
+        list of (part, reason) of the failed parts, ordered by part number
+    '''
+    thread_num = max(1, min(thread_num, len(part_msg_list)))
+    part_queue, threadpool = start_part_workers(create_worker, thread_num)
+    for part in part_msg_list:
+        part_queue.put(part)
+    return join_part_workers(part_queue, threadpool)
+
+def start_part_workers(create_worker, thread_num=10, maxsize=0):
+    '''
+    Start thread_num workers made by create_worker(part_queue) on a new
+    queue of at most maxsize parts, for parts produced while uploading.
+
+    Returns:
+        (part_queue, threadpool)
+    '''
+    part_queue = queue.Queue(maxsize)
+    threadpool = []
+    for i in range(thread_num):
+        current = create_worker(part_queue)
+        threadpool.append(current)
+        current.start()
+    return (part_queue, threadpool)
+
+def join_part_workers(part_queue, threadpool):
+    '''
+    Stop the workers of start_part_workers once the queued parts are done.
+
+    Returns:
+        list of (part, reason) of the failed parts, ordered by part number
+    '''
+    for item in threadpool:
+        part_queue.put(None)
+    failed_part_list = []
+    for item in threadpool:
+        item.join()
+        failed_part_list.extend(item.failed_part_list)
+    failed_part_list.sort(key=lambda failed: failed[0][0])
+    return failed_part_list
+
+def format_failed_parts(failed_part_list):
+    return ", ".join("%s(%s)" % (part[0], reason) for part, reason in failed_part_list)
+
+class PutObjectGroupWorker(PartWorker):
+    def __init__(self, oss, bucket, file_path, part_msg_list, retry_times=5, part_md5_map=None):
+        PartWorker.__init__(self, part_msg_list)
         self.oss = oss
         self.bucket = bucket
-        self.part_msg_list = part_msg_list
         self.file_path = file_path
         self.retry_times = retry_times
+        self.part_md5_map = part_md5_map
+        if self.part_md5_map is None:
+            self.part_md5_map = {}
 
     def run(self):
-        for part in self.part_msg_list:
+        for part in self.iter_parts():
             if len(part) == 5:
                 bucket = self.bucket
                 file_name = part[1]
                 object_name = file_name
-                retry_times = self.retry_times
                 is_skip = False
-                while True:
-                    try:
-                        if retry_times <= 0:
-                            break
-                        res = self.oss.head_object(bucket, object_name)
-                        if res.status == 200:
-                            header_map = convert_header2map(res.getheaders())
-                            etag = safe_get_element("etag", header_map)
-                            md5 = part[2]
-                            if etag.replace('"', "").upper() == md5.upper():
-                                is_skip = True
-                        break
-                    except:
-                        retry_times = retry_times - 1
-                        time.sleep(1)
+                try:
+                    res = self.oss.head_object(bucket, object_name)
+                    if res.status == 200:
+                        etag = get_header_map(res).get("etag", "")
+                        md5 = self.get_part_md5(part)
+                        if etag.replace('"', "").upper() == md5.upper():
+                            self.add_done_part(part, md5)
+                            is_skip = True
+                except Exception:
+                    #not known to be there, upload it
+                    pass
 
                 if is_skip:
                     continue
 
                 partsize = part[3]
                 offset = part[4]
-                retry_times = self.retry_times
-                while True:
-                    try:
-                        if retry_times <= 0:
-                            break
-                        res = self.oss.put_object_from_file_given_pos(bucket, object_name, self.file_path, offset, partsize)
-                        if res.status != 200:
-                            print("upload ", file_name, "failed!", " ret is:", res.status)
-                            print("headers", res.getheaders())
-                            retry_times = retry_times - 1
-                            time.sleep(1)
-                        else:
-                            break
-                    except:
-                        retry_times = retry_times - 1
-                        time.sleep(1)
+                #the put retries by the retry policy of oss, a part that
+                #still fails is retried by the next pass over failed parts
+                try:
+                    start_time = time.time()
+                    res = self.oss.put_object_from_file_given_pos(bucket, object_name, self.file_path, offset, partsize, '', None, None, True)
+                    res.read()
+                    if res.status == 200:
+                        self.oss.throughput_meter.record(partsize, time.time() - start_time)
+                    if res.status == 200 and not self.check_sent_part(part, res):
+                        print("upload ", file_name, "failed!", " md5 mismatch")
+                        self.add_failed_part(part, "md5 mismatch")
+                    elif res.status != 200:
+                        print("upload ", file_name, "failed!", " ret is:", res.status)
+                        print("headers", res.getheaders())
+                        self.add_failed_part(part, res.status)
+                except Exception as e:
+                    self.add_failed_part(part, repr(e))
 
             else:
                 print("ERROR! part", part , " is not as expected!")
+                self.add_failed_part(part, "malformed part")
 
-class UploadPartWorker(Thread):
-    def __init__(self, oss, bucket, object, upoload_id, file_path, part_msg_list, uploaded_part_map, retry_times=5, debug=DEBUG):
-        Thread.__init__(self)
+class UploadPartWorker(PartWorker):
+    def __init__(self, oss, bucket, object, upoload_id, file_path, part_msg_list, uploaded_part_map, retry_times=5, debug=DEBUG, part_md5_map=None, checkpoint=None):
+        PartWorker.__init__(self, part_msg_list, checkpoint)
         self.oss = oss
         self.bucket = bucket
         self.object = object
-        self.part_msg_list = part_msg_list
         self.file_path = file_path
         self.upload_id = upoload_id
         self.uploaded_part_map = uploaded_part_map
         self.retry_times = retry_times
         self.logger = getlogger(debug)
+        self.part_md5_map = part_md5_map
+        if self.part_md5_map is None:
+            self.part_md5_map = {}
 
     def run(self):
-        for part in self.part_msg_list:
+        for part in self.iter_parts():
             part_number = str(part[0])
             if len(part) == 5:
                 bucket = self.bucket
                 object = self.object
+                if part[0] in self.part_md5_map:
+                    continue
                 if part_number in self.uploaded_part_map:
-                    md5 = part[2]
+                    md5 = self.get_part_md5(part)
                     if self.uploaded_part_map[part_number].replace('"', "").upper() == md5.upper():
+                        self.add_done_part(part, md5)
                         continue
 
                 partsize = part[3]
                 offset = part[4]
-                retry_times = self.retry_times
-                while True:
-                    try:
-                        if retry_times <= 0:
-                            break
-                        res = self.oss.upload_part_from_file_given_pos(bucket, object, self.file_path, offset, partsize, self.upload_id, part_number)
-                        if res.status != 200:
-                            self.logger.warn("Upload %s/%s from %s, failed! ret is:%s." %(bucket, object, self.file_path, res.status))
-                            self.logger.warn("headers:%s" % res.getheaders())
-                            retry_times = retry_times - 1
-                            time.sleep(1)
-                        else:
-                            self.logger.info("Upload %s/%s from %s, OK! ret is:%s." % (bucket, object, self.file_path, res.status))
-                            break
-                    except:
-                        retry_times = retry_times - 1
-                        time.sleep(1)
+                #the upload retries by the retry policy of oss, a part that
+                #still fails is retried by the next pass over failed parts
+                try:
+                    start_time = time.time()
+                    res = self.oss.upload_part_from_file_given_pos(bucket, object, self.file_path, offset, partsize, self.upload_id, part_number, hash_content=True)
+                    res.read()
+                    if res.status == 200 and not self.check_sent_part(part, res):
+                        self.logger.warn("Upload %s/%s part %s from %s, failed! md5 mismatch." % (bucket, object, part_number, self.file_path))
+                        self.add_failed_part(part, "md5 mismatch")
+                    elif res.status != 200:
+                        self.logger.warn("Upload %s/%s from %s, failed! ret is:%s." %(bucket, object, self.file_path, res.status))
+                        self.logger.warn("headers:%s" % res.getheaders())
+                        self.add_failed_part(part, res.status)
+                    else:
+                        self.oss.throughput_meter.record(partsize, time.time() - start_time)
+                        self.logger.info("Upload %s/%s from %s, OK! ret is:%s." % (bucket, object, self.file_path, res.status))
+                except Exception as e:
+                    self.logger.warn("Upload %s/%s part %s from %s, failed! error is:%r." % (bucket, object, part_number, self.file_path, e))
+                    self.add_failed_part(part, repr(e))
             else:
                 self.logger.error("ERROR! part %s is not as expected!" % part)
+                self.add_failed_part(part, "malformed part")
 
-class MultiGetWorker(Thread):
-    def __init__(self, oss, bucket, object, file, start, end, retry_times=5):
-        Thread.__init__(self)
+class UploadDataPartWorker(PartWorker):
+    '''
+    Upload parts given as (part_order, data) from memory, data being any
+    bytes-like object, e.g. a memoryview slice of a larger buffer. The md5
+    of each part is kept in part_md5_map.
+    '''
+    def __init__(self, oss, bucket, object, upload_id, part_msg_list, retry_times=5, debug=DEBUG, part_md5_map=None):
+        PartWorker.__init__(self, part_msg_list)
+        self.oss = oss
+        self.bucket = bucket
+        self.object = object
+        self.upload_id = upload_id
+        self.retry_times = retry_times
+        self.logger = getlogger(debug)
+        self.part_md5_map = part_md5_map
+        if self.part_md5_map is None:
+            self.part_md5_map = {}
+
+    def run(self):
+        for part in self.iter_parts():
+            (part_order, data) = part
+            part_md5 = md5(data).hexdigest()
+            #the upload retries by the retry policy of oss
+            try:
+                start_time = time.time()
+                res = self.oss.upload_part_from_bytes(self.bucket, self.object, data, self.upload_id, part_order)
+                res.read()
+                etag = get_header_map(res).get("etag", "").replace('"', "")
+                if res.status == 200 and etag and etag.upper() != part_md5.upper():
+                    self.logger.warn("Upload %s/%s part %s, failed! md5 mismatch." % (self.bucket, self.object, part_order))
+                    self.add_failed_part(part, "md5 mismatch")
+                elif res.status != 200:
+                    self.logger.warn("Upload %s/%s part %s, failed! ret is:%s." % (self.bucket, self.object, part_order, res.status))
+                    self.add_failed_part(part, res.status)
+                else:
+                    self.oss.throughput_meter.record(memoryview(data).nbytes, time.time() - start_time)
+                    self.part_md5_map[part_order] = part_md5
+            except Exception as e:
+                self.logger.warn("Upload %s/%s part %s, failed! error is:%r." % (self.bucket, self.object, part_order, e))
+                self.add_failed_part(part, repr(e))
+
+class MultiGetWorker(PartWorker):
+    '''
+    Download the bytes start to end (inclusive) of an object into file, or
+    every (start, end) of range_list, a list or a queue.Queue shared with
+    other workers. file is a file object, closed when the worker is done,
+    or a file descriptor written with os.pwrite at the offset of each range,
+    so many workers can share it. The ranges that could not be downloaded
+    are kept in failed_part_list, the others are added to checkpoint.
+    '''
+    def __init__(self, oss, bucket, object, file, start, end, retry_times=5, range_list=None, headers=None, checkpoint=None):
+        if range_list is None:
+            range_list = [(start, end)]
+        PartWorker.__init__(self, range_list, checkpoint)
         self.oss = oss
         self.bucket = bucket
         self.object = object
         self.startpos = start
         self.endpos = end
         self.file = file
-        self.length = self.endpos - self.startpos + 1
+        self.headers = headers
         self.need_read = 0
         self.get_buffer_size = 10*1024*1024
+        self.buffer = None
         self.retry_times = retry_times
 
-    def run(self):
-        if self.startpos >= self.endpos:
+    def write(self, offset, content):
+        if not isinstance(self.file, int):
+            self.file.write(content)
             return
+        view = memoryview(content)
+        while len(view) > 0:
+            written = os.pwrite(self.file, view, offset)
+            view = view[written:]
+            offset += written
+
+    def sync(self):
+        '''
+        Make the ranges written so far durable.
+        '''
+        if isinstance(self.file, int):
+            sync_file_data(self.file)
+        else:
+            self.file.flush()
+            sync_file_data(self.file.fileno())
+
+    def get_range(self, start, end):
+        '''
+        Returns:
+            None if the range was written, else the reason it failed
+        '''
+        #the buffer of run, or one borrowed for this range only
+        buf = self.buffer or self.oss.buffer_pool.get(self.get_buffer_size)
+        try:
+            length = end - start + 1
+            view = memoryview(buf)[:self.get_buffer_size]
+            retry = self.oss.retry_policy.start(self.retry_times)
+            while True:
+                headers = HeaderMap(self.headers)
+                if not isinstance(self.file, int):
+                    self.file.seek(start)
+                self.need_read = 0
+                headers['Range'] = 'bytes=%d-%d' % (start, end)
+                try:
+                    res = self.oss.object_operation("GET", self.bucket, self.object, headers, retry_state=retry)
+                    if res.status == 206:
+                        while self.need_read < length:
+                            n = res.readinto(view[:length - self.need_read])
+                            if n:
+                                self.write(start + self.need_read, view[:n])
+                                self.need_read += n
+                            else:
+                                break
+                        if self.need_read >= length:
+                            return None
+                        reason = "incomplete read"
+                        is_retry = retry.should_retry(error=http.client.IncompleteRead(b''))
+                    else:
+                        res.read()
+                        reason = res.status
+                        is_retry = retry.should_retry(status=res.status)
+                except Exception as e:
+                    reason = repr(e)
+                    is_retry = retry.should_retry(error=e)
+                if not is_retry:
+                    print("ERROR, reach max retry times:%s when multi get /%s/%s" % (self.retry_times, self.bucket, self.object))
+                    return reason
+                retry.sleep()
+        finally:
+            if buf is not self.buffer:
+                self.oss.buffer_pool.put(buf)
 
-        retry_times = 0
-        while True:
-            headers = {}
-            self.file.seek(self.startpos)
-            headers['Range'] = 'bytes=%d-%d' % (self.startpos, self.endpos)
-            try:
-                res = self.oss.object_operation("GET", self.bucket, self.object, headers)
-                if res.status == 206:
-                    while self.need_read < self.length:
-                        left_len = self.length - self.need_read
-                        if left_len > self.get_buffer_size:
-                            content = res.read(self.get_buffer_size)
-                        else:
-                            content = res.read(left_len)
-                        if content:
-                            self.need_read += len(content)
-                            self.file.write(content)
-                        else:
-                            break
-                    break
-            except:
-                pass
-            retry_times += 1
-            if retry_times > self.retry_times:
-                print("ERROR, reach max retry times:%s when multi get /%s/%s" % (self.retry_times, self.bucket, self.object))
-                break 
-
-        self.file.flush()
-        self.file.close()
+    def run(self):
+        #one buffer for all the ranges of this worker
+        self.buffer = self.oss.buffer_pool.get(self.get_buffer_size)
+        try:
+            for (start, end) in self.iter_parts():
+                if start > end:
+                    continue
+                reason = self.get_range(start, end)
+                if reason is not None:
+                    self.add_failed_part((start, end), reason)
+                elif self.checkpoint is not None:
+                    self.sync()
+                    self.checkpoint.add_range(start, end)
+        finally:
+            self.oss.buffer_pool.put(self.buffer)
+            self.buffer = None
+
+        if not isinstance(self.file, int):
+            self.file.flush()
+            self.file.close()
 
 ############### misc ###############
+HASH_BUFFER_SIZE = 1024*1024
+#smaller files are hashed inline, the read-ahead thread is not worth it
+READAHEAD_MIN_SIZE = 4*HASH_BUFFER_SIZE
+#service limits of multipart upload
+MAX_PART_NUM = 10000
+MIN_PART_SIZE = 100*1024
+MAX_PART_SIZE = 5*1024*1024*1024
+DEFAULT_PART_SIZE = 10*1024*1024
+PART_SIZE_ALIGN = 64*1024
+
+def get_part_file_name(file_path, object_prefix, part_order):
+    temp_file_name = os.path.basename(file_path) + "_" + str(part_order)
+    if not object_prefix:
+        return sum_string(temp_file_name) + "_" + temp_file_name
+    return object_prefix + "/" + sum_string(temp_file_name) + "_" + temp_file_name
+
+def plan_large_file(file_path, object_prefix="", max_part_num=1000, part_size=10*1024*1024):
+    '''
+    Yield the parts of file_path as (part_order, file_name, md5, size, offset)
+    without reading the file. md5 is left empty, it is computed while the
+    part is uploaded.
+    '''
+    if not os.path.isfile(file_path):
+        print("ERROR! No file: ", file_path, ", please check.")
+        return
+    file_size = os.path.getsize(file_path)
+    if file_size > part_size * max_part_num:
+        part_size = (file_size + max_part_num - file_size % max_part_num) // max_part_num
+    part_num = (file_size + part_size - 1) // part_size
+    for i in range(0, part_num):
+        part_order = i + 1
+        offset = part_size * i
+        real_part_size = min(part_size, file_size - offset)
+        yield (part_order, get_part_file_name(file_path, object_prefix, part_order), "", real_part_size, offset)
+
+class ThroughputMeter:
+    '''
+    Moving average of the bytes per second of one connection, measured on
+    the parts uploaded so far. Shared by all workers of one OssAPI.
+    '''
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.throughput = 0
+        self.lock = threading.Lock()
 
-def split_large_file(file_path, object_prefix="", max_part_num=1000, part_size=10*1024*1024, buffer_size=10*1024):
-    parts_list = []
-
-    if os.path.isfile(file_path):
-        file_size = os.path.getsize(file_path)
-
-        if file_size > part_size * max_part_num:
-            part_size = (file_size + max_part_num - file_size % max_part_num) / max_part_num
-
-        part_order = 1
-        fp = open(file_path, 'rb')
-        fp.seek(os.SEEK_SET)
-
-        part_num = (file_size + part_size - 1) / part_size
+    def record(self, size, seconds):
+        if size <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            if self.throughput:
+                self.throughput = self.alpha * size / seconds + (1 - self.alpha) * self.throughput
+            else:
+                self.throughput = size / seconds
 
-        for i in xrange(0, part_num):
-            left_len = part_size
-            real_part_size = 0
-            m = md5.new()
-            offset = part_size * i
-            while True:
-                read_size = 0
-                if left_len <= 0:
-                    break
-                elif left_len < buffer_size:
-                    read_size = left_len
-                else:
-                    read_size = buffer_size
+    def get(self):
+        return self.throughput
 
-                buffer_content = fp.read(read_size)
-                m.update(buffer_content)
-                real_part_size += len(buffer_content)
+def get_stream_part_size(part_size, part_order, grow_num=1000):
+    '''
+    Size of part part_order of a stream of unknown size: part_size for the
+    first grow_num parts, then doubled every grow_num parts up to
+    MAX_PART_SIZE, so that MAX_PART_NUM parts hold terabytes.
+    '''
+    return min(max(part_size, MIN_PART_SIZE) << ((part_order - 1) // grow_num), MAX_PART_SIZE)
 
-                left_len = left_len - read_size
+def clamp_part_size(part_size, file_size, max_part_num=MAX_PART_NUM):
+    '''
+    Returns part_size raised to MIN_PART_SIZE and to the size that keeps
+    file_size within max_part_num parts, and lowered to MAX_PART_SIZE.
+    '''
+    part_size = max(part_size, MIN_PART_SIZE, (file_size + max_part_num - 1) // max_part_num)
+    return min(part_size, MAX_PART_SIZE)
 
-            md5sum = m.hexdigest()
+def plan_part_size(file_size, thread_num=10, max_part_num=MAX_PART_NUM, throughput=0, part_seconds=5, parts_per_thread=4):
+    '''
+    Pick the part size and the number of threads of a multipart upload.
 
-            temp_file_name = os.path.basename(file_path) + "_" + str(part_order)
-            if not object_prefix:
-                file_name = sum_string(temp_file_name) + "_" + temp_file_name
-            else:
-                file_name = object_prefix + "/" + sum_string(temp_file_name) + "_" + temp_file_name
-            part_msg = (part_order, file_name, md5sum, real_part_size, offset)
-            parts_list.append(part_msg)
-            part_order += 1
+    Without a measured throughput the part size is DEFAULT_PART_SIZE. With
+    one it is the size a connection sends in part_seconds, so fast links use
+    fewer and bigger requests. Small files are cut into parts_per_thread
+    parts per thread to keep all threads busy. The result always respects
+    max_part_num, MIN_PART_SIZE and MAX_PART_SIZE.
 
-        fp.close()
+    Returns:
+        (part_size, thread_num)
+    '''
+    if throughput > 0:
+        part_size = int(throughput * part_seconds)
     else:
-        print("ERROR! No file: ", file_path, ", please check.")
+        part_size = DEFAULT_PART_SIZE
+    if thread_num < 1:
+        thread_num = 1
+    parallel_part_size = (file_size + thread_num * parts_per_thread - 1) // (thread_num * parts_per_thread)
+    part_size = min(part_size, parallel_part_size)
+    part_size = (part_size + PART_SIZE_ALIGN - 1) // PART_SIZE_ALIGN * PART_SIZE_ALIGN
+    part_size = clamp_part_size(part_size, file_size, max_part_num)
+    part_num = max(1, (file_size + part_size - 1) // part_size)
+    return part_size, min(thread_num, part_num)
+
+def split_large_file(file_path, object_prefix="", max_part_num=1000, part_size=10*1024*1024, buffer_size=HASH_BUFFER_SIZE, thread_num=0, use_process=False, hash_index=None):
+    '''
+    Split file_path into parts and hash them with hash_file_parts, or take
+    the md5 from hash_index if the file did not change since.
 
-    return parts_list
+    Returns:
+        list of (part_order, file_name, md5, size, offset)
+    '''
+    parts_list = list(plan_large_file(file_path, object_prefix, max_part_num, part_size))
+    parts_list = fill_part_md5_from_index(hash_index, file_path, parts_list)
+    if not parts_list or parts_list[0][2]:
+        return parts_list
+    if hash_index is not None:
+        file_stat = hash_index.get_stat(file_path)
+    md5_list = hash_file_parts(file_path, [(part[4], part[3]) for part in parts_list], thread_num, use_process, buffer_size)
+    if hash_index is not None:
+        hash_index.put(file_path, md5_list, parts_list[0][3], file_stat)
+    return [(part[0], part[1], part_md5, part[3], part[4]) for part, part_md5 in zip(parts_list, md5_list)]
+
+def fill_part_md5_from_index(hash_index, file_path, part_msg_list):
+    '''
+    Returns part_msg_list with the md5 of the parts taken from hash_index,
+    unchanged if the index does not know them.
+    '''
+    if hash_index is None or not part_msg_list:
+        return part_msg_list
+    md5_list = hash_index.get(file_path, part_msg_list[0][3])
+    if not md5_list or len(md5_list) != len(part_msg_list):
+        return part_msg_list
+    return [(part[0], part[1], part_md5, part[3], part[4]) for part, part_md5 in zip(part_msg_list, md5_list)]
+
+def fill_part_md5(part_msg_list, part_md5_map):
+    '''
+    Returns part_msg_list with the md5 of each part taken from part_md5_map
+    when the planner left it empty.
+    '''
+    return [(part[0], part[1], part[2] or part_md5_map[part[0]], part[3], part[4]) for part in part_msg_list]
 
 def sumfile(fobj):
     '''Returns an md5 hash for an object with read() method.'''
-    m = md5.new()
+    m = md5()
     while True:
         d = fobj.read(8096)
         if not d:
@@ -860,54 +2533,270 @@ def sumfile(fobj):
         m.update(d)
     return m.hexdigest()
 
-def md5sum(fname):
+def sumfile_buffered(fobj, buffer_size=HASH_BUFFER_SIZE):
+    '''
+    Returns an md5 hash for a binary file object, read with readinto into
+    a buffer reused by the calling thread.
+    '''
+    m = md5()
+    view = memoryview(_get_hash_buffer(buffer_size))
+    while True:
+        n = fobj.readinto(view)
+        if not n:
+            break
+        m.update(view[:n])
+    return m.hexdigest()
+
+def sumfile_readahead(fobj, buffer_size=HASH_BUFFER_SIZE):
+    '''
+    Returns an md5 hash for a binary file object. MD5 of one stream can only
+    be computed in order, so the next block is read by a second thread while
+    the current one is hashed, with two reused buffers.
+    '''
+    free_queue = queue.Queue()
+    full_queue = queue.Queue()
+    for i in range(2):
+        free_queue.put(bytearray(buffer_size))
+
+    def read_ahead():
+        try:
+            while True:
+                buf = free_queue.get()
+                n = fobj.readinto(buf)
+                full_queue.put((buf, n))
+                if not n:
+                    return
+        except Exception as e:
+            full_queue.put((e, 0))
+
+    reader = Thread(target=read_ahead)
+    reader.daemon = True
+    reader.start()
+    m = md5()
+    while True:
+        buf, n = full_queue.get()
+        if isinstance(buf, Exception):
+            raise buf
+        if not n:
+            break
+        m.update(memoryview(buf)[:n])
+        free_queue.put(buf)
+    reader.join()
+    return m.hexdigest()
+
+def md5sum(fname, hash_index=None):
     '''Returns an md5 hash for file fname, or stdin if fname is "-".'''
     if fname == '-':
-        ret = sumfile(sys.stdin)
+        ret = sumfile(sys.stdin.buffer)
     else:
+        if hash_index is not None:
+            ret = hash_index.get(fname)
+            if ret:
+                return ret
         try:
-            f = file(fname, 'rb')
+            f = open(fname, 'rb', buffering=0)
+            file_stat = os.fstat(f.fileno())
         except:
             return 'Failed to open file'
-        ret = sumfile(f)
-        f.close()
+        try:
+            if file_stat.st_size < READAHEAD_MIN_SIZE:
+                ret = sumfile_buffered(f)
+            else:
+                ret = sumfile_readahead(f)
+        finally:
+            f.close()
+        if hash_index is not None:
+            hash_index.put(fname, ret, 0, (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino))
     return ret
 
-def md5sum2(filename, offset=0, partsize=0):
-    m = md5.new()
-    fp = open(filename, 'rb')
-    if offset > os.path.getsize(filename):
-        fp.seek(os.SEEK_SET, os.SEEK_END)
-    else:
+_hash_local = threading.local()
+
+def _get_hash_buffer(buffer_size):
+    buf = getattr(_hash_local, 'buffer', None)
+    if buf is None or len(buf) != buffer_size:
+        buf = bytearray(buffer_size)
+        _hash_local.buffer = buf
+    return buf
+
+def md5sum2(filename, offset=0, partsize=0, buffer_size=HASH_BUFFER_SIZE):
+    '''
+    Returns the md5 hash of partsize bytes of filename from offset. The file
+    is read with readinto into a buffer reused by the calling thread.
+    '''
+    m = md5()
+    view = memoryview(_get_hash_buffer(buffer_size))
+    fp = open(filename, 'rb', buffering=0)
+    try:
         fp.seek(offset)
+        left_len = partsize
+        while left_len > 0:
+            n = fp.readinto(view[:min(left_len, buffer_size)])
+            if not n:
+                break
+            m.update(view[:n])
+            left_len -= n
+    finally:
+        fp.close()
+    return m.hexdigest()
 
-    left_len = partsize
-    BufferSize = 8 * 1024
-    while True:
-        if left_len <= 0:
-            break
-        elif left_len < BufferSize:
-            buffer_content = fp.read(left_len)
-        else:
-            buffer_content = fp.read(BufferSize)
-        m.update(buffer_content)
-        left_len = left_len - len(buffer_content)
-    md5sum = m.hexdigest()
-    return md5sum
+def _md5sum2_args(args):
+    return md5sum2(*args)
+
+def hash_file_parts(file_path, range_list, thread_num=0, use_process=False, buffer_size=HASH_BUFFER_SIZE):
+    '''
+    Compute the md5 of every (offset, size) of range_list of file_path in
+    parallel. Threads are used by default, hashlib releases the GIL while
+    hashing large buffers; use_process hashes in a process pool instead.
+
+    Returns:
+        list of md5 hex digests in the order of range_list
+    '''
+    if not range_list:
+        return []
+    if thread_num <= 0:
+        thread_num = os.cpu_count() or 1
+    thread_num = min(thread_num, len(range_list))
+    args_list = [(file_path, offset, size, buffer_size) for offset, size in range_list]
+    if thread_num == 1:
+        return [_md5sum2_args(args) for args in args_list]
+    if use_process:
+        executor = concurrent.futures.ProcessPoolExecutor(thread_num)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(thread_num)
+    with executor:
+        return list(executor.map(_md5sum2_args, args_list, chunksize=max(1, len(args_list) // (thread_num * 4)) if use_process else 1))
 
 def sum_string(content):
-    f = io.io(content)
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    f = io.BytesIO(content)
     md5sum = sumfile(f)
     f.close()
     return md5sum
 
+class HeaderMap(MutableMapping):
+    '''
+    Case-insensitive dict of HTTP headers. Lookups are O(1), iteration gives
+    the keys in the case they were last set.
+    '''
+    __slots__ = ('store',)
+
+    def __init__(self, headers=None):
+        self.store = {}
+        if headers:
+            if isinstance(headers, HeaderMap):
+                self.store = headers.store.copy()
+            else:
+                self.update(headers)
+
+    def __getitem__(self, key):
+        return self.store[key.lower()][1]
+
+    def __setitem__(self, key, value):
+        self.store[key.lower()] = (key, value)
+
+    def __delitem__(self, key):
+        del self.store[key.lower()]
+
+    def __contains__(self, key):
+        return isinstance(key, str) and key.lower() in self.store
+
+    def __iter__(self):
+        return (item[0] for item in self.store.values())
+
+    def __len__(self):
+        return len(self.store)
+
+    def get(self, key, default=None):
+        item = self.store.get(key.lower())
+        if item is None:
+            return default
+        return item[1]
+
+    def items(self):
+        return list(self.store.values())
+
+    def lower_items(self):
+        '''
+        (lower key, value) pairs
+        '''
+        return [(k, item[1]) for (k, item) in self.store.items()]
+
+    def copy(self):
+        return HeaderMap(self)
+
+    def __repr__(self):
+        return "HeaderMap(%r)" % dict(self.items())
+
+def get_header_map(res):
+    '''
+    HeaderMap of the headers of a response.
+    '''
+    header_map = getattr(res, 'header_map', None)
+    if isinstance(header_map, HeaderMap):
+        return header_map
+    return HeaderMap(res.getheaders())
+
+def get_byte_view(buffer):
+    '''
+    Returns a one-dimensional memoryview of the bytes of buffer, without
+    copying. buffer is str (sent as utf-8) or any C-contiguous object of the
+    buffer protocol: bytes, bytearray, memoryview, mmap, NumPy array...
+    '''
+    if isinstance(buffer, str):
+        buffer = buffer.encode('utf-8')
+    view = memoryview(buffer)
+    if view.ndim != 1 or view.format != 'B':
+        if not view.c_contiguous:
+            raise Exception("-1, the buffer to upload must be C-contiguous.")
+        view = view.cast('B')
+    elif not view.contiguous:
+        raise Exception("-1, the buffer to upload must be contiguous.")
+    return view
+
+def open_preallocated_file(filename, size):
+    '''
+    Open filename for writing at offsets and give it size bytes, allocated on
+    disk where the file system supports it.
+
+    Returns:
+        file descriptor
+    '''
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    fd = os.open(filename, flags, 0o666)
+    try:
+        os.ftruncate(fd, size)
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                pass
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def get_sendfile_fileno(fp):
+    '''
+    the file descriptor of fp if it is a regular file opened in binary mode,
+    which os.sendfile can send from, else -1.
+    '''
+    if not hasattr(os, 'sendfile') or 'b' not in getattr(fp, 'mode', ''):
+        return -1
+    try:
+        fileno = fp.fileno()
+        if stat.S_ISREG(os.fstat(fileno).st_mode):
+            return fileno
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        pass
+    return -1
+
 def convert_header2map(header_list):
-    header_map = {}
-    for (a, b) in header_list:
-        header_map[a] = b
-    return header_map
+    return HeaderMap(header_list)
 
 def safe_get_element(name, container):
+    if isinstance(container, HeaderMap):
+        return container.get(name.strip(), "")
     for k, v in container.items():
         if k.strip().lower() == name.strip().lower():
             return v